@@ -20,6 +20,11 @@ Plugin function:	This script allows you to "traceback" any structure anywhere
             structure.
 Examples:		PDBtraceback.py 
             PDBtraceback.py -f test.pdb
+            PDBtraceback.py -d run1 -w -i 30
+            PDBtraceback.py -t 200
+            PDBtraceback.py --stage it0 -s -150 -v
+            PDBtraceback.py -r 'runs/run*' --serve /tmp/traceback.sock
+            PDBtraceback.py -d run1 -l -M 512 --tmpdir /scratch
 Plugin dependencies:	None
 
 for further information, please contact:
@@ -33,57 +38,876 @@ reference:
 """
 
 """import modules"""
-import os, sys, copy
+import os, re, io, sys, bz2, csv, glob, gzip, json, mmap, stat, time, heapq, shutil, struct, bisect, hashlib, logging, sqlite3, tempfile, itertools, threading, tracemalloc
+from contextlib import contextmanager
+from array import array
 from time import ctime
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ROWFORMAT = '%35s%10.0f%15.4f%10.0f%15.4f%10.0f%15.4f\n'
+STAGES = ('it0', 'it1', 'water')
+CACHEVERSION = 5
+EXPORTS = {'text': 'traceback.list', 'csv': 'traceback.csv', 'tsv': 'traceback.tsv', 'parquet': 'traceback.parquet',
+           'binary': 'traceback.tbk'}
+BINARYMAGIC = b'TBK1'
+COMPRESSORS = {'.gz': gzip, '.bz2': bz2}
+FILELISTLINE = re.compile(rb'_(\d+)w?(?:\.\w+)*"?[ \t]+\S+[ \t]+(\S+)')
+LOGLEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}
+HEADER = '      complex                             it0      hscoreit0       it1      hscoreit1      water      hscorew\n'
+
+log = logging.getLogger('PDBtraceback')
+
 
 def PluginCore(paramdict, inputlist):
 
-    print("--> Starting PDB traceback process")
+    log.info("--> Starting PDB traceback process")
 
-    if inputlist == None:
-        traceback = StructureTraceback()
+    try:
+        RunTraceback(paramdict, inputlist)
+    except TracebackError as error:
+        log.error("    * ERROR: %s" % error)
+        sys.exit(0)
+
+def RunTraceback(paramdict, inputlist):
+
+    profile = TracebackProfile(enabled=paramdict.get('profile', False))
+
+    if paramdict.get('top') != None or paramdict.get('maxscore') != None:
+        traceback = StructureTraceback(profile=profile)
+        traceback.Rundir(paramdict)
+        with profile.Phase('GetStartStruc') as phase:
+            traceback.GetStartStruc()
+            phase['rows'] = len(traceback.complex_list)
+        with profile.Phase('SelectLineage') as phase:
+            traceback.SelectLineage(stage=paramdict.get('stage', 'water'), top=paramdict['top'], maxscore=paramdict['maxscore'])
+            phase['rows'] = len(traceback.lineage)
+        with profile.Phase('WriteFile') as phase:
+            traceback.WriteFile(verbose=paramdict['verbose'],longout=True,format=paramdict.get('format', 'text'),compress=paramdict.get('compress'))
+            phase['rows'] = len(traceback.lineage)
+
+    elif inputlist == None and paramdict.get('memory') != None:
+        if not paramdict.get('format', 'text') in ('text', 'csv', 'tsv'):
+            raise TracebackError("Format %s can not be written with -M, use text, csv or tsv" % paramdict['format'])
+        traceback = StructureTraceback(profile=profile)
+        traceback.Rundir(paramdict)
+        try:
+            traceback.TraceExternal(memory=int(paramdict['memory']*2**20), tmpdir=paramdict.get('tmpdir'))
+            with profile.Phase('WriteFile') as phase:
+                traceback.WriteStream(verbose=paramdict['verbose'],longout=paramdict['longout'],format=paramdict.get('format', 'text'),compress=paramdict.get('compress'))
+                phase['rows'] = sum(len(rows) for rows in traceback.external) if paramdict['longout'] else traceback.nrstrucw
+        finally:
+            traceback.RemoveTemporary()
+
+    elif inputlist == None:
+        traceback = StructureTraceback(profile=profile)
         traceback.Rundir(paramdict)
         # traceback.GetBasedir()
-        traceback.GetStartStruc()
-        traceback.GetWatStructures()
-        traceback.GetIt1Structures()
-        traceback.GetIt0Structures()
-        traceback.WriteFile(verbose=paramdict['verbose'],longout=paramdict['longout'])
+        traceback.Trace(cache=paramdict.get('cache', False))
+        with profile.Phase('WriteFile') as phase:
+            traceback.WriteFile(verbose=paramdict['verbose'],longout=paramdict['longout'],format=paramdict.get('format', 'text'),compress=paramdict.get('compress'))
+            phase['rows'] = len(traceback.lineage) if paramdict['longout'] else min(traceback.nrstrucw, len(traceback.lineage))
 
     else:
-        pdb = []
+        traceback = StructureTraceback(profile=profile)
         for n in inputlist:
-            base, extension = os.path.splitext(os.path.basename(n))
+            base, extension = os.path.splitext(os.path.basename(Uncompressed(n)))
             if extension == ".pdb":
-                pdb.append(base)
+                traceback.IDStructures(filelist=[n])
             else:
                 try:
-                    files = file(n, 'r')
-                    lines = files.readlines()
+                    with OpenFile(n, 'r') as files:
+                        lines = files.readlines()
+                    pdb = []
                     for line in lines:
-                        if line == '\n':
+                        if line.strip() == '':
                             pass
                         else:
                             pdb.append(line)
-                    print("    * Supply traceback information for file", os.path.basename(n))
-                except:
-                    print("    * ERROR: Could not parse file")
-                    sys.exit(0)
+                    log.info("    * Supply traceback information for file %s" % os.path.basename(n))
+                except IOError:
+                    raise TracebackError("Could not parse file %s" % n)
+                stage = os.path.basename(os.path.dirname(n))
+                traceback.IDStructures(filelist=pdb, stage=stage if stage in STAGES else None)
 
-        traceback = StructureTraceback()
-        traceback.IDStructures(filelist=pdb)
         traceback.Rundir(paramdict)
-        traceback.GetStartStruc()
-        traceback.GetWatStructures()
-        traceback.GetIt1Structures()
-        traceback.GetIt0Structures()
-        traceback.ReportQuery(verbose=paramdict['verbose'])
+        traceback.Trace(cache=paramdict.get('cache', False))
+        with profile.Phase('ReportQuery') as phase:
+            traceback.ReportQuery(verbose=paramdict['verbose'], compress=paramdict.get('compress'))
+            phase['rows'] = len(traceback.query)
+
+    profile.Write(traceback.rundir)
+
+def LoadLineage(rundir, longout=False, cache=False, profile=None):
+
+    """Trace a run directory and return the resolved lineage as an in-memory LineageTable instead of writing
+       traceback.list. Without longout only the structures that reached the water refinement are kept. The
+       phases are recorded in profile if given"""
+
+    traceback = StructureTraceback(profile=profile)
+    traceback.Rundir({'inputdir': rundir})
+    traceback.Trace(cache=cache)
+
+    if longout == True:
+        return traceback.lineage
+    return traceback.lineage.Head(traceback.nrstrucw)
+
+def TraceRun(rundir, longout=False, merge=False, cache=False, format='text', profile=False, compress=None):
+
+    """Trace a single run directory without touching the working directory of the process, used as worker
+       by TraceRuns. Exports the lineage to the run directory or, when merging, returns the LineageTable. With
+       profile the phases are written to the profile sidecar of the run"""
+
+    profile = TracebackProfile(enabled=profile)
+    lineage = LoadLineage(rundir, longout=longout, cache=cache, profile=profile)
+
+    if merge == True:
+        profile.Write(lineage.rundir)
+        return lineage
+
+    with profile.Phase('ExportLineage') as phase:
+        ExportLineage(lineage, lineage.rundir, format=format, compress=compress)
+        phase['rows'] = len(lineage)
+    profile.Write(lineage.rundir)
+
+def FollowRun(rundir, interval=10.0, longout=False, format='text', updates=None, compress=None):
+
+    """Trace a run while HADDOCK is still running. The stage file lists are polled every interval seconds and
+       only the lines appended since the previous poll are parsed. Whenever a stage grew the lineage is resolved
+       again and the export is replaced atomically. Stops after updates refreshes, or never when None"""
+
+    traceback = StructureTraceback()
+    traceback.Rundir({'inputdir': rundir})
+    traceback.GetStartStruc()
+
+    followers = {}
+    for stage in STAGES:
+        followers[stage] = StageFollower()
+
+    log.info("--> Following run %s, polling every %.1f seconds (Ctrl-C to stop)" % (traceback.rundir, interval))
+    try:
+        while updates == None or updates > 0:
+            changed = []
+            for stage in STAGES:
+                sources = traceback._Sources(stage)
+                if sources and followers[stage].Poll(sources[0]):
+                    changed.append(stage)
+
+            if changed and len(followers['it0'].table) > 0:
+                traceback.SetIt0Structures(followers['it0'].table)
+                traceback.SetIt1Structures(followers['it1'].table)
+                traceback.SetWatStructures(followers['water'].table)
+                traceback.ResolveLineage()
+                traceback.WriteFile(longout=longout, format=format, compress=compress)
+                if updates != None:
+                    updates = updates-1
+            if updates == None or updates > 0:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        log.info("    * Stopped following run %s" % traceback.rundir)
+
+    return traceback
+
+def Serve(rundirs, address, cache=False, interval=1.0):
+
+    """Keep the lineage of the runs in memory and answer JSON queries (see TracebackService) until interrupted.
+       An address with a '/' or ending in .sock is a Unix domain socket taking one JSON request per line,
+       otherwise it is the port, or localhost:port, of an HTTP server on the loopback interface"""
+
+    import socketserver
+    from http.server import ThreadingHTTPServer
+
+    unix = '/' in address or address.endswith('.sock')
+    if unix and os.path.exists(address) and not stat.S_ISSOCK(os.stat(address).st_mode):
+        raise TracebackError("%s exists and is not a socket" % address)
+
+    service = TracebackService(rundirs, cache=cache, interval=interval)
+    SocketHandler, HTTPHandler = ServiceHandlers()
+
+    if unix:
+        if os.path.exists(address):
+            os.remove(address)   #a socket left behind by an earlier service
+        server = socketserver.ThreadingUnixStreamServer(address, SocketHandler)
+        log.info("--> Serving %i runs on Unix socket %s (Ctrl-C to stop)" % (len(service.runs), address))
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', int(address.split(':')[-1])), HTTPHandler)
+        log.info("--> Serving %i runs on http://127.0.0.1:%i (Ctrl-C to stop)" % (len(service.runs), server.server_address[1]))
+    server.daemon_threads = True
+    server.service = service
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("    * Stopped serving")
+    finally:
+        server.server_close()
+        if unix and os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.remove(address)
+
+def QueryService(address, request):
+
+    """Send one request to a Unix socket service started with Serve and return the decoded response"""
+
+    import socket
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(address)
+        connection.sendall(json.dumps(request).encode() + b'\n')
+        with connection.makefile('rb') as response:
+            return json.loads(response.readline())
+
+def ExportLineage(lineage, outdir, format='text', compress=None):
+
+    """Write a LineageTable to outdir in one of the EXPORTS formats with a single buffered write. 'binary' is
+       written as Parquet when pyarrow is installed and as struct packed columns (see ReadLineage) otherwise.
+       Unlike the text format, the exports keep full score precision. With compress ('gz' or 'bz2') the file is
+       compressed, Parquet compresses its columns itself. The file is replaced atomically. Returns the path of
+       the written file"""
+
+    pyarrow = Pyarrow() if format in ('binary', 'parquet') else None
+    if format == 'binary' and pyarrow != None:
+        format = 'parquet'
+    if format == 'parquet' and pyarrow == None:
+        raise TracebackError("parquet export requires pyarrow, use -o binary")
+    final, path = ExportPath(outdir, format, compress)
+
+    if format == 'text':
+        with OpenFile(path, 'w') as outfile:
+            outfile.write(''.join(lineage.Lines()))
+
+    elif format in ('csv', 'tsv'):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=',' if format == 'csv' else '\t', lineterminator='\n')
+        writer.writerow(LineageTable.COLUMNS)
+        writer.writerows(lineage)
+        with OpenFile(path, 'w') as outfile:
+            outfile.write(buffer.getvalue())
+
+    elif format == 'parquet':
+        columns = lineage.Columns()
+        pyarrow.parquet.write_table(pyarrow.table(dict((name, list(columns[name])) for name in LineageTable.COLUMNS)), path)
+
+    else:
+        blob = [BINARYMAGIC, struct.pack('<II', len(lineage), len(lineage.complexes))]
+        for text in [lineage.rundir] + list(lineage.complexes):
+            text = text.encode('utf-8')
+            blob.append(struct.pack('<I', len(text)) + text)
+        for column in [lineage.ComplexIndex()] + [lineage.Column(name) for name in LineageTable.COLUMNS[1:]]:
+            if sys.byteorder == 'big':
+                column.byteswap()
+            blob.append(column.tobytes())
+        with OpenFile(path, 'wb') as outfile:
+            outfile.write(b''.join(blob))
+
+    os.replace(path, final)
+
+    return final
+
+def ExportPath(outdir, format='text', compress=None):
+
+    """(final, temporary) path of an export. The file is written next to the final file and renamed, readers
+       never see a partial file"""
+
+    if not format in EXPORTS:
+        raise TracebackError("Unknown export format %s, use one of %s" % (format, ', '.join(sorted(EXPORTS))))
+    final = os.path.join(outdir, EXPORTS[format])
+    if compress and format != 'parquet':
+        final = final + '.' + compress
+
+    return final, os.path.join(outdir, '.' + os.path.basename(final))
+
+def ExportRows(rows, header, outdir, format='text', compress=None):
+
+    """Streaming version of ExportLineage for rows that are produced one at a time, see
+       StructureTraceback.ExternalRows. Only the row formats text, csv and tsv can be written this way"""
+
+    if not format in ('text', 'csv', 'tsv'):
+        raise TracebackError("Format %s can not be written row by row, use text, csv or tsv" % format)
+    final, path = ExportPath(outdir, format, compress)
+
+    with OpenFile(path, 'w') as outfile:
+        if format == 'text':
+            outfile.write(header)
+            for row in rows:
+                outfile.write(ROWFORMAT % row)
+        else:
+            writer = csv.writer(outfile, delimiter=',' if format == 'csv' else '\t', lineterminator='\n')
+            writer.writerow(LineageTable.COLUMNS)
+            writer.writerows(rows)
+
+    os.replace(path, final)
+
+    return final
+
+def ReadLineage(path):
+
+    """Read a lineage export written by ExportLineage, compressed or not, back into a dictionary of columns"""
+
+    extension = os.path.splitext(Uncompressed(path))[1]
+
+    if extension == '.parquet':
+        pyarrow = Pyarrow()
+        if pyarrow == None:
+            raise TracebackError("Reading %s requires pyarrow" % path)
+        return pyarrow.parquet.read_table(path).to_pydict()
+
+    if extension in ('.csv', '.tsv'):
+        with OpenFile(path, 'r') as infile:
+            reader = csv.reader(infile, delimiter=',' if extension == '.csv' else '\t')
+            names = next(reader)
+            values = list(zip(*reader)) or [()] * len(names)
+        columns = {'complex': list(values[0])}
+        for name, column in zip(names[1:], values[1:]):
+            columns[name] = array('i' if name in STAGES else 'd', map(int if name in STAGES else float, column))
+        return columns
+
+    with OpenFile(path, 'rb') as infile:
+        blob = infile.read()
+    if blob[0:4] != BINARYMAGIC:
+        raise TracebackError("%s is not a binary traceback file" % path)
+
+    nrows, nrcomplexes = struct.unpack_from('<II', blob, 4)
+    offset = 12
+    texts = []
+    for n in range(nrcomplexes+1):
+        size = struct.unpack_from('<I', blob, offset)[0]
+        texts.append(blob[offset+4:offset+4+size].decode('utf-8'))
+        offset = offset+4+size
+
+    columns = {}
+    for name in ('complexindex',) + LineageTable.COLUMNS[1:]:
+        column = array('d' if name.startswith('hscore') else 'i')
+        column.frombytes(blob[offset:offset+nrows*column.itemsize])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns[name] = column
+        offset = offset+nrows*column.itemsize
+
+    complexes = texts[1:]
+    columns['complex'] = [complexes[n] if n >= 0 else '' for n in columns.pop('complexindex')]
+    columns['rundir'] = texts[0]
+
+    return columns
+
+def TraceRuns(rundirs, workers=None, longout=False, merge=None, cache=False, format='text', profile=False, compress=None):
+
+    """Trace many run directories (paths or UNIX glob patterns) over a pool of worker processes. Every run gets
+       its own traceback.list (or other export format), or all rows are merged in a single table with a leading run column when merge
+       is a file name. A failing run is reported and does not stop the others. Returns {run: error message}
+       for the failed runs"""
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    runs = []
+    for pattern in rundirs:
+        runs.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    log.info("--> Tracing %i runs" % len(runs))
+
+    results = {}
+    failed = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for run in runs:
+            futures[pool.submit(TraceRun, run, longout, merge != None, cache, format, profile, compress)] = run
+        for future in as_completed(futures):
+            run = futures[future]
+            try:
+                results[run] = future.result()
+            except Exception as error:
+                failed[run] = str(error)
+                log.error("    * ERROR: Traceback of run %s failed: %s" % (run, error))
+
+    if merge != None:
+        outfile = OpenFile(merge, 'w')
+        outfile.write('run                           ' + HEADER)
+        for run in runs:
+            for row in results.get(run, []):
+                outfile.write('%-30s' % run + ROWFORMAT % row)
+        outfile.close()
+        log.info("    * Merged traceback information written to file %s" % merge)
+
+    log.info("    * %i of %i runs traced successfully" % (len(runs)-len(failed), len(runs)))
+    return failed
+
+def OpenFile(path, mode='r', buffering=-1):
+
+    """open() that streams the (de)compression of files ending in .gz or .bz2. Text modes stay text modes"""
+
+    module = COMPRESSORS.get(os.path.splitext(path)[1])
+    if module == None:
+        return open(path, mode, buffering)
+    if not 'b' in mode and not 't' in mode:
+        mode = mode + 't'
+
+    return module.open(path, mode)
+
+def Compressed(path):
+
+    return os.path.splitext(path)[1] in COMPRESSORS
+
+def Uncompressed(path):
+
+    """path without a .gz or .bz2 extension"""
+
+    if Compressed(path):
+        return os.path.splitext(path)[0]
+    return path
+
+def FindFile(path):
+
+    """path or, when only that exists, its compressed version path.gz or path.bz2"""
+
+    if not os.path.isfile(path):
+        for extension in COMPRESSORS:
+            if os.path.isfile(path + extension):
+                return path + extension
+
+    return path
+
+def StructureNumber(name):
+
+    """Structure number of a HADDOCK structure name or path, e.g. 12 for PREVIT:complex_12w.pdb"""
+
+    base = os.path.basename(name.strip('"').split(':')[-1])
+    return int(base.split('.')[0].split('_')[-1].rstrip('w'))
+
+def IterFileList(path):
+
+    """Generator over a HADDOCK file.list or file.list_all yielding (structure number, HADDOCK score, structure
+       name) line by line in constant memory"""
+
+    with OpenFile(path, 'r') as filelist:
+        for line in filelist:
+            fields = line.split()
+            if len(fields) > 2:
+                yield StructureNumber(fields[0]), float(fields[2]), fields[0].strip('"').split(':')[-1]
+
+def ParseFileList(path, bulk=True):
+
+    """Parse a HADDOCK file.list or file.list_all into a StageTable. The bulk parser runs one regular expression
+       over the memory mapped file, or over the decompressed content of a compressed list, bulk=False builds the
+       table line by line from IterFileList"""
+
+    table = StageTable()
+
+    if bulk == False:
+        for number, score, name in IterFileList(path):
+            table.Append(number, score)
+        return table
+
+    if Compressed(path):
+        with OpenFile(path, 'rb') as filelist:
+            matches = FILELISTLINE.findall(filelist.read())
+    else:
+        with open(path, 'rb') as filelist:
+            if os.fstat(filelist.fileno()).st_size == 0:
+                return table
+            buffer = mmap.mmap(filelist.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                matches = FILELISTLINE.findall(buffer)
+            finally:
+                buffer.close()
+
+    if len(matches) > 0:
+        numbers, scores = zip(*matches)
+        table.number = array('i', map(int, numbers))
+        table.score = array('d', map(float, scores))
+
+    return table
+
+def BeginLists(begindir):
+
+    """The file_1.list, file_2.list, ... (or compressed versions) of every body in the begin directory, followed
+       by the first missing one so that a body added later is noticed by the cache"""
+
+    lists = []
+    while len(lists) == 0 or os.path.isfile(lists[-1]):
+        lists.append(FindFile(os.path.join(begindir, 'file_%i.list' % (len(lists)+1))))
+
+    return lists
+
+def Argsort(column):
+
+    """Stable argsort of an array column, vectorised with NumPy when it is installed"""
+
+    if numpy != None:
+        return array('i', numpy.argsort(numpy.frombuffer(column, dtype=column.typecode), kind='stable').astype('i').tobytes())
+
+    return array('i', sorted(range(len(column)), key=column.__getitem__))
+
+def Smallest(column, count=None, maximum=None, tiebreak=None):
+
+    """Row indexes of the count smallest values of an array column and/or of all values <= maximum, ordered on
+       value with ties on tiebreak or on row index, as a stable sort would. Partial selection with argpartition or
+       heapq, only the selected rows are sorted"""
+
+    if numpy != None:
+        values = numpy.frombuffer(column, dtype=column.typecode)
+        if maximum == None:
+            rows = numpy.arange(len(values))
+        else:
+            rows = numpy.flatnonzero(values <= maximum)
+        if count != None and 0 < count < len(rows):
+            selected = values[rows]
+            rows = rows[selected <= numpy.partition(selected, count-1)[count-1]]
+        if tiebreak == None:
+            keys = rows
+        else:
+            keys = numpy.frombuffer(tiebreak, dtype=tiebreak.typecode)[rows]
+        rows = rows[numpy.lexsort((keys, values[rows]))][0:count]
+        return array('i', rows.astype('i').tobytes())
+
+    if maximum == None:
+        rows = range(len(column))
+    else:
+        rows = [n for n in range(len(column)) if column[n] <= maximum]
+    if tiebreak == None:
+        key = column.__getitem__
+    else:
+        key = lambda n: (column[n], tiebreak[n])
+    if count == None:
+        return array('i', sorted(rows, key=key))
+
+    return array('i', heapq.nsmallest(count, rows, key=key))
+
+def StablePositions(column, rows):
+
+    """Position of the rows in a stable sort of an array column, as SetIt0Structures sorts it0 on structure
+       number, without sorting the column: one counting pass adds up the values smaller than that of a row and
+       the equal values in earlier rows. Only the distinct values of rows are sorted"""
+
+    if len(rows) == 0:
+        return array('i')
+
+    if numpy != None:
+        values = numpy.frombuffer(column, dtype=column.typecode)
+        selected = numpy.unique(values[numpy.frombuffer(rows, dtype='i')])
+        #values <= selected[i-1] are the ones smaller than selected[i]
+        smaller = numpy.cumsum(numpy.bincount(numpy.searchsorted(selected, values, side='right'), minlength=len(selected)+1))
+        slot = numpy.minimum(numpy.searchsorted(selected, values), len(selected)-1)
+        equal = numpy.flatnonzero(selected[slot] == values)
+        groups = slot[equal]
+        order = numpy.argsort(groups, kind='stable')
+        earlier = numpy.empty(len(equal), dtype=numpy.int64)
+        earlier[order] = numpy.arange(len(equal)) - numpy.searchsorted(groups[order], groups[order])
+        before = dict(zip(equal.tolist(), earlier.tolist()))
+        smaller = dict(zip(selected.tolist(), smaller.tolist()))
+        return array('i', [smaller[column[row]] + before[row] for row in rows])
+
+    selected = sorted(set(column[row] for row in rows))
+    counts = [0]*(len(selected)+1)
+    seen = dict((value, 0) for value in selected)
+    wanted = set(rows)
+    before = {}
+    for n, value in enumerate(column):
+        counts[bisect.bisect_right(selected, value)] += 1
+        if value in seen:
+            if n in wanted:
+                before[n] = seen[value]
+            seen[value] += 1
+    smaller = dict(zip(selected, itertools.accumulate(counts)))
+
+    return array('i', [smaller[column[row]] + before[row] for row in rows])
+
+def Take(column, order):
+
+    """Reorder an array column by the row indices in order"""
+
+    if numpy != None and len(order) > 0:
+        return array(column.typecode, numpy.frombuffer(column, dtype=column.typecode)[numpy.frombuffer(order, dtype='i')].tobytes())
+
+    return array(column.typecode, [column[n] for n in order])
+
+def Pyarrow():
+
+    """pyarrow with pyarrow.parquet, imported on first use as it is slow to import, None when not installed"""
+
+    try:
+        import pyarrow, pyarrow.parquet
+    except ImportError:
+        return None
+
+    return pyarrow
+
+def TracebackHeader(rundir, counts, query=False):
+
+    """The traceback.list header of a run with counts (it0, it1, water) structures"""
+
+    header = ['*****************************************************************************************************************\n',
+              'Structure traceback information for run %s\n' % rundir,
+              'Date/time: %s\n' % ctime(),
+              'Number of structures: %i in it0, %i in it1 and %i in water refinement\n' % tuple(counts),
+              'Sorting order: water(struct. nr.) matches it1 (struct. nr.) matches it0 (struct. nr.) matches input structures.\n',
+              '*****************************************************************************************************************\n']
+    if query == True:
+        header.append('      complex                              it0      hscoreit0       it1      hscoreit1      water      hscorew\n')
+    else:
+        header.append(HEADER)
+
+    return ''.join(header)
 
 #=====================================================================================================================#
 # 					PLUGIN SPECIFIC DEFINITIONS BELOW THIS LINE						                                  #
 #=====================================================================================================================#
 
+class TracebackProfile:
+
+    """Records wall time, rows processed and peak memory of the phases of a traceback. A disabled profile records
+       nothing and costs a function call per phase"""
+
+    def __init__(self, enabled=False):
+
+        self.enabled = enabled
+        self.phases = []
+
+    @contextmanager
+    def Phase(self, name):
+
+        """Context measuring the phase called name. Yields the record of the phase, the phase sets its 'rows'"""
+
+        record = {'phase': name, 'rows': None}
+        if self.enabled == False:
+            yield record
+            return
+
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            record['peakbytes'] = tracemalloc.get_traced_memory()[1]
+            if not tracing:
+                tracemalloc.stop()
+            if resource != None:
+                record['maxrss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.phases.append(record)
+            log.debug("    * %s: %.3f s, %s rows, peak %i bytes" % (name, record['seconds'], record['rows'], record['peakbytes']))
+
+    def Write(self, rundir, filename='traceback.profile.json'):
+
+        """Write the recorded phases as JSON sidecar next to the traceback output in rundir"""
+
+        if self.enabled == False:
+            return None
+
+        path = os.path.join(rundir, filename)
+        with open(path, 'w') as outfile:
+            json.dump({'rundir': rundir, 'date': ctime(), 'pid': os.getpid(), 'phases': self.phases}, outfile, indent=1)
+        log.info("    * Profile written to file '%s' in directory %s" % (filename, rundir))
+
+        return path
+
+class TracebackService:
+
+    """Resident lineage of one or more runs answering JSON requests, used by Serve. A run is traced once and
+       traced again when the size or mtime of one of its file lists changed, checked at most every interval
+       seconds. Requests are dictionaries with an 'op':
+
+       runs                                          the loaded runs and their number of structures
+       structure  run, structures, [stage]           lineage rows of structure identifiers as accepted by -f
+       top        run, [stage], [n], [maxscore]      the n best structures and/or those scoring <= maxscore
+       batch      queries                            a list of requests answered in one round trip
+       reload     run                                trace a run again
+
+       run may be left out when only one run is loaded. Rows are dictionaries with the traceback.list columns"""
+
+    def __init__(self, rundirs, cache=False, interval=1.0):
+
+        self.cache = cache
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.runs = {}
+        for pattern in rundirs:
+            for rundir in sorted(glob.glob(pattern)) or [pattern]:
+                self.Load(rundir)
+
+    def Load(self, rundir):
+
+        """Trace rundir into memory, keyed on its directory name or on the path when names clash"""
+
+        traceback = StructureTraceback()
+        traceback.Rundir({'inputdir': rundir})
+        traceback.Trace(cache=self.cache)
+
+        name = os.path.basename(traceback.rundir)
+        if name in self.runs and self.runs[name]['traceback'].rundir != traceback.rundir:
+            name = traceback.rundir
+        self.runs[name] = {'traceback': traceback, 'stat': self._Stat(traceback), 'checked': time.time(), 'order': {}}
+        log.info("    * Loaded run %s with %i structures" % (name, len(traceback.lineage)))
+
+        return name
+
+    def _Stat(self, traceback):
+
+        stat = []
+        for source in traceback._Sources('all'):
+            if os.path.isfile(source):
+                info = os.stat(source)
+                stat.append((source, info.st_size, info.st_mtime_ns))
+
+        return stat
+
+    def Run(self, name=None):
+
+        """The entry of a run, traced again first when its file lists changed"""
+
+        if name == None and len(self.runs) == 1:
+            name = list(self.runs)[0]
+        if not name in self.runs:
+            raise TracebackError("Unknown run %s, loaded are %s" % (name, ', '.join(sorted(self.runs))))
+
+        entry = self.runs[name]
+        if time.time() - entry['checked'] > self.interval:
+            with self.lock:
+                entry = self.runs[name]
+                entry['checked'] = time.time()
+                if self._Stat(entry['traceback']) != entry['stat']:
+                    log.info("    * File lists of run %s changed, reloading" % name)
+                    self.Load(entry['traceback'].rundir)
+                    entry = self.runs[name]
+
+        return entry
+
+    def _Row(self, row):
+
+        return dict(zip(LineageTable.COLUMNS, row))
+
+    def _Order(self, entry, stage):
+
+        """Lineage rows holding a structure of stage, best score first, computed once per loaded run"""
+
+        if not stage in entry['order']:
+            traceback = entry['traceback']
+            table = traceback.lineage.stages[STAGES.index(stage)]
+            index = traceback.LineageIndex()[stage]
+            order = Smallest(table.score, tiebreak=table.number if stage == 'it0' else None)
+            entry['order'][stage] = array('i', [index[table.number[n]] for n in order if table.number[n] in index])
+
+        return entry['order'][stage]
+
+    def Query(self, request):
+
+        """Answer one request, errors are returned as {'error': message}"""
+
+        try:
+            op = request.get('op')
+            if not op in ('runs', 'batch', 'reload', 'structure', 'top'):
+                raise TracebackError("Unknown op %s" % op)
+            if op == 'runs':
+                return {'runs': dict((name, len(self.Run(name)['traceback'].lineage)) for name in list(self.runs))}
+            if op == 'batch':
+                return {'results': [self.Query(query) for query in request.get('queries', [])]}
+            if op == 'reload':
+                return {'run': self.Load(self.Run(request.get('run'))['traceback'].rundir)}
+
+            entry = self.Run(request.get('run'))
+            traceback = entry['traceback']
+            if op == 'structure':
+                structures = request.get('structures', [])
+                if isinstance(structures, str):
+                    structures = [structures]
+                rows = []
+                for lib, number, row in traceback.QueryStructures(structures=structures, stage=request.get('stage')):
+                    rows.append(None if row == None else self._Row(row))
+                return {'rows': rows}
+            if op == 'top':
+                stage = request.get('stage', 'water')
+                if not stage in STAGES:
+                    raise TracebackError("Unknown stage %s" % stage)
+                n, maxscore = request.get('n'), request.get('maxscore')
+                rows = []
+                for row in self._Order(entry, stage):
+                    if n != None and len(rows) >= int(n):
+                        break
+                    values = traceback.lineage[row]
+                    if maxscore != None and values[2*STAGES.index(stage)+2] > float(maxscore):
+                        break
+                    rows.append(self._Row(values))
+            return {'rows': rows}
+        except (TracebackError, ValueError, TypeError, AttributeError, KeyError) as error:
+            return {'error': str(error)}
+
+def ServiceHandlers():
+
+    """(SocketHandler, HTTPHandler) request handlers of Serve. Defined on demand so that the socket and HTTP
+       server modules are only imported when serving"""
+
+    import socketserver
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    class SocketHandler(socketserver.StreamRequestHandler):
+
+        """One JSON request per line in, one JSON response per line out, for as long as the client stays connected"""
+
+        def handle(self):
+
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    response = self.server.service.Query(json.loads(line))
+                except ValueError as error:
+                    response = {'error': "Invalid JSON request: %s" % error}
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+                self.wfile.flush()
+
+    class HTTPHandler(BaseHTTPRequestHandler):
+
+        """JSON requests as POST body, or as GET /<op>?run=..&structures=a,b&n=.. query string"""
+
+        def _Respond(self, response):
+
+            body = json.dumps(response).encode()
+            self.send_response(400 if 'error' in response else 200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+
+            url = urlparse(self.path)
+            request = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+            request['op'] = url.path.strip('/') or 'runs'
+            if 'structures' in request:
+                request['structures'] = request['structures'].split(',')
+            self._Respond(self.server.service.Query(request))
+
+        def do_POST(self):
+
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError as error:
+                request = None
+                self._Respond({'error': "Invalid JSON request: %s" % error})
+            if request != None:
+                self._Respond(self.server.service.Query(request))
+
+        def log_message(self, format, *args):
+
+            log.debug("    * %s %s" % (self.address_string(), format % args))
+
+    return SocketHandler, HTTPHandler
+
+class TracebackError(Exception):
+
+    """Raised when a run directory can not be traced"""
+
 class CommandlineOptionParser:
 
     """Parses command line arguments using optparse"""
@@ -102,18 +926,50 @@ class CommandlineOptionParser:
 
         parser.add_option( "-d", "--dir", dest="inputdir", nargs=1, type="string", help="Directory path of HADDOCK run.")
         parser.add_option( "-f", "--file", action="callback", callback=self.varargs, dest="inputfile", type="string", help="Supply pdb or file.nam inputfile(s). Standard UNIX selection syntax accepted")
+        parser.add_option( "-r", "--runs", action="callback", callback=self.varargs, dest="runs", help="Trace many run directories in parallel. Standard UNIX selection syntax accepted")
+        parser.add_option( "-j", "--workers", dest="workers", type="int", default=None, help="Number of worker processes used with -r, default=number of CPUs")
+        parser.add_option( "-m", "--merge", dest="merge", type="string", default=None, help="With -r, merge all runs in one table written to this file instead of a traceback.list per run")
+        parser.add_option( "-c", "--cache", action="store_true", dest="cache", default=False, help="Keep the parsed stages and lineage in a traceback.cache file in the run directory and reuse them while the file lists do not change, default=False")
+        parser.add_option( "-o", "--format", dest="format", type="choice", choices=sorted(EXPORTS), default="text", help="Output format: text (traceback.list), csv, tsv, binary (Parquet when pyarrow is installed, otherwise struct packed columns) or parquet, default=text")
+        parser.add_option( "-z", "--compress", dest="compress", type="choice", choices=sorted(ext.lstrip('.') for ext in COMPRESSORS), default=None, help="Compress the output: gz or bz2, compressed input is always read transparently")
+        parser.add_option( "--serve", dest="serve", type="string", default=None, help="Keep the runs (-d or -r) in memory and answer JSON queries on this Unix socket path or localhost HTTP port")
+        parser.add_option( "-M", "--memory", dest="memory", type="float", default=None, help="Bounded memory mode for runs larger than memory: sort the stages in chunks on disk and merge them using about this many MB, writes text, csv or tsv")
+        parser.add_option( "--tmpdir", dest="tmpdir", type="string", default=None, help="Directory for the temporary files of -M, default=system temporary directory")
+        parser.add_option( "-w", "--follow", action="store_true", dest="follow", default=False, help="Keep tracing a run that is still running, the output is refreshed when the stage file lists grow")
+        parser.add_option( "-i", "--interval", dest="interval", type="float", default=10.0, help="Seconds between polls of the file lists with -w, default=10")
         parser.add_option( "-l", "--longout", action="store_true", dest="longout", default=False, help="Long output also includes all structures rejected in it0 and it1, default=False")
         parser.add_option( "-v", "--verbose", action="store_true", dest="verbose", default=False, help="All output to standard output")
+        parser.add_option( "-t", "--top", dest="top", type="int", default=None, help="Only trace the N best structures of the --stage")
+        parser.add_option( "-s", "--max-score", dest="maxscore", type="float", default=None, help="Only trace the structures of the --stage with a HADDOCK score of at most this value")
+        parser.add_option( "--stage", dest="stage", type="choice", choices=STAGES, default="water", help="Stage selected from with --top and --max-score: it0, it1 or water, default=water")
+        parser.add_option( "-p", "--profile", action="store_true", dest="profile", default=False, help="Record time, rows and peak memory of every phase in traceback.profile.json next to the output, default=False")
+        parser.add_option( "--loglevel", dest="loglevel", type="choice", choices=sorted(LOGLEVELS), default="info", help="Amount of progress messages: debug, info, warning or error, default=info")
 
         (options, args) = parser.parse_args()
+        logging.basicConfig(stream=sys.stdout, format='%(message)s', level=LOGLEVELS[options.loglevel])
         if not options.inputdir and len(args) > 0:
-            print("    * ERROR: Argument without option associated detected (use -d to target a directory)")
+            log.error("    * ERROR: Argument without option associated detected (use -d to target a directory)")
             sys.exit(0)
 
         self.option_dict['inputdir'] = options.inputdir
         self.option_dict['input'] = options.inputfile
         self.option_dict['longout'] = options.longout
         self.option_dict['verbose'] = options.verbose
+        self.option_dict['runs'] = options.runs
+        self.option_dict['cache'] = options.cache
+        self.option_dict['format'] = options.format
+        self.option_dict['compress'] = options.compress
+        self.option_dict['memory'] = options.memory
+        self.option_dict['tmpdir'] = options.tmpdir
+        self.option_dict['serve'] = options.serve
+        self.option_dict['follow'] = options.follow
+        self.option_dict['interval'] = options.interval
+        self.option_dict['profile'] = options.profile
+        self.option_dict['top'] = options.top
+        self.option_dict['maxscore'] = options.maxscore
+        self.option_dict['stage'] = options.stage
+        self.option_dict['workers'] = options.workers
+        self.option_dict['merge'] = options.merge
 
         if not self.option_dict['input'] == None:
             parser.remove_option('-f')
@@ -171,120 +1027,821 @@ class CommandlineOptionParser:
 
         setattr(parser.values, option.dest, value)
 
-class StructureTraceback:
+class TracebackCache:
 
-    """Traceback any structure within a run directory all the way back to the individual components that
-       were used in the docking"""
+    """SQLite cache inside the run directory holding the parsed stages and the resolved lineage. Every entry
+       keeps the size/mtime and a SHA1 hash of the file lists it was made from. An entry is used as long as
+       the sizes/mtimes are unchanged, or when they changed but the content hash did not. Entries are JSON
+       values followed by the raw bytes of array columns, never pickles: run directories are often writable
+       by a whole group and loading the cache must not be able to run code"""
+
+    def __init__(self, rundir, filename='traceback.cache'):
+
+        self.path = os.path.join(rundir, filename)
+        self.digests = {}
+
+        try:
+            self._Connect()
+        except sqlite3.DatabaseError as error:
+            if not 'not a database' in str(error):
+                raise
+            if getattr(self, 'db', None) != None:
+                self.db.close()
+            os.remove(self.path)   #a damaged or foreign file, start a fresh cache
+            self._Connect()
+
+    def _Connect(self):
+
+        self.db = sqlite3.connect(self.path)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != CACHEVERSION:
+            self.db.execute('DROP TABLE IF EXISTS stages')
+            self.db.execute('PRAGMA user_version = %i' % CACHEVERSION)
+        self.db.execute('CREATE TABLE IF NOT EXISTS stages (stage TEXT PRIMARY KEY, stat TEXT, digest TEXT, data BLOB)')
+
+    def _Stat(self, sources):
+
+        stat = []
+        for source in sources:
+            if os.path.isfile(source):
+                info = os.stat(source)
+                stat.append((source, info.st_size, info.st_mtime_ns))
+
+        return repr(stat)
+
+    def _Digest(self, sources):
+
+        digest = hashlib.sha1()
+        for source in sources:
+            if os.path.isfile(source):
+                if not source in self.digests:
+                    filehash = hashlib.sha1()
+                    with open(source, 'rb') as infile:
+                        for block in iter(lambda: infile.read(1 << 20), b''):
+                            filehash.update(block)
+                    self.digests[source] = filehash.hexdigest()
+                digest.update(source.encode() + self.digests[source].encode())
+
+        return digest.hexdigest()
+
+    def Load(self, stage, sources):
+
+        """Return the data cached for stage if its sources did not change, None otherwise"""
+
+        entry = self.db.execute('SELECT stat, digest, data FROM stages WHERE stage = ?', (stage,)).fetchone()
+        if entry == None:
+            return None
+
+        stat = self._Stat(sources)
+        if entry[0] != stat:
+            if entry[1] != self._Digest(sources):
+                return None
+            self.db.execute('UPDATE stages SET stat = ? WHERE stage = ?', (stat, stage))
+            self.db.commit()
+
+        return self._Decode(entry[2])
+
+    def Store(self, stage, sources, values, columns=()):
+
+        """Cache the JSON serialisable values and the array columns of stage"""
+
+        self.db.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?)', (stage, self._Stat(sources), self._Digest(sources),
+                        sqlite3.Binary(self._Encode(values, columns))))
+        self.db.commit()
+
+    def _Encode(self, values, columns):
+
+        meta = json.dumps({'values': values, 'byteorder': sys.byteorder,
+                           'columns': [(column.typecode, len(column)) for column in columns]}).encode('utf-8')
+
+        return b''.join([struct.pack('<I', len(meta)), meta] + [column.tobytes() for column in columns])
+
+    def _Decode(self, blob):
+
+        """(values, columns) of an entry, None for an entry that can not be read"""
+
+        try:
+            size = struct.unpack_from('<I', blob)[0]
+            meta = json.loads(bytes(blob[4:4+size]).decode('utf-8'))
+            if meta['byteorder'] != sys.byteorder:
+                return None
+            offset = 4+size
+            columns = []
+            for typecode, length in meta['columns']:
+                if not typecode in 'ild':
+                    return None
+                column = array(typecode)
+                column.frombytes(blob[offset:offset+length*column.itemsize])
+                if len(column) != length:
+                    return None
+                columns.append(column)
+                offset = offset+length*column.itemsize
+        except (ValueError, KeyError, TypeError, struct.error):
+            return None
+
+        return meta['values'], columns
+
+    def Close(self):
+
+        self.db.close()
+
+class StageFollower:
+
+    """Tails the file list of a stage. Each Poll parses only the complete lines appended since the previous
+       one into table, a file list that was rewritten or truncated is read again from the start"""
+
+    HEADSIZE = 4096
 
     def __init__(self):
 
-        self.file_1_list = []
-        self.file_2_list = []
-        self.complex_list = []
+        self.table = StageTable()
+        self.path = None
+        self.offset = 0
+        self.head = b''
+        self.rest = b''
+        self.inode = None
+
+    def Poll(self, path):
+
+        """Ingest new lines of path, returns True when the table changed"""
+
+        if not os.path.isfile(path):
+            return False
 
-        self.fileit0_list = []
-        self.fileit1_list = []
-        self.filew_list = []
-        self.query = {}
+        if Compressed(path):
+            #a compressed list is complete, it is only read again when it is replaced
+            stat = os.stat(path)
+            if path == self.path and (stat.st_ino, stat.st_size, stat.st_mtime_ns) == self.inode:
+                return False
+            changed = len(self.table) > 0
+            self.__init__()
+            self.path = path
+            self.inode = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            self.table = ParseFileList(path)
+            return changed or len(self.table) > 0
 
+        changed = False
+        with open(path, 'rb') as filelist:
+            stat = os.fstat(filelist.fileno())
+            head = filelist.read(len(self.head))
+            if path != self.path or stat.st_ino != self.inode or stat.st_size < self.offset or head != self.head:
+                changed = len(self.table) > 0
+                self.__init__()
+                self.path = path
+                self.inode = stat.st_ino
 
-    def _FormatLine(self, line):
+            filelist.seek(self.offset)
+            data = self.rest + filelist.read()
+            self.offset = filelist.tell()
+            if len(self.head) < self.HEADSIZE:
+                filelist.seek(0)
+                self.head = filelist.read(min(self.offset, self.HEADSIZE))
 
-        base = os.path.splitext(line.strip('""'))
-        base2 = (base[0].split(':'))[1]
-        base3 = base2.split('_')[-1]
+        end = data.rfind(b'\n')+1
+        self.rest = data[end:]
+        for number, score in FILELISTLINE.findall(data, 0, end):
+            self.table.Append(int(number), float(score))
+            changed = True
 
+        return changed
+
+class InputCombinations:
+
+    """The input complexes of a run as a lazy sequence over any number of bodies. Complex n combines one
+       structure of every body, the last body varying fastest as in generate_complex.inp, so the structure
+       indexes of complex n follow from its mixed radix digits. Names are only formatted on access"""
+
+    def __init__(self, bodies):
+
+        self.bodies = bodies
+
+    def __len__(self):
+
+        if len(self.bodies) == 0:
+            return 0
+        size = 1
+        for body in self.bodies:
+            size = size*len(body)
+
+        return size
+
+    def __iter__(self):
+
+        for n in range(len(self)):
+            yield self[n]
+
+    def __getitem__(self, n):
+
+        return '/'.join(body[index] for body, index in zip(self.bodies, self.Indexes(n)))
+
+    def Indexes(self, n):
+
+        """Tuple with the index of the structure of every body in complex n"""
+
+        if not 0 <= n < len(self):
+            raise IndexError("Input complex %i out of range" % n)
+
+        indexes = []
+        for body in reversed(self.bodies):
+            n, index = divmod(n, len(body))
+            indexes.append(index)
+
+        return tuple(reversed(indexes))
+
+class ExternalSort:
+
+    """Sort records that need not fit in memory. Records are tuples packed with the struct format and are sorted
+       on their natural tuple order. About memory bytes of records are buffered, a full buffer is sorted and
+       written to a temporary run file in tmpdir. Iterating, once, merges the runs with heapq.merge while reading
+       every run in small blocks. When nothing was written to disk the buffer is simply sorted"""
+
+    def __init__(self, format, memory, tmpdir):
+
+        self.record = struct.Struct(format)
+        self.memory = memory
+        self.tmpdir = tmpdir
+        self.chunk = None
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+
+    def __len__(self):
+
+        return self.count
+
+    def Add(self, record):
+
+        if self.chunk == None:
+            size = sys.getsizeof(record) + sum(sys.getsizeof(field) for field in record) + 8
+            self.chunk = max(1024, self.memory // size)
+        self.buffer.append(record)
+        self.count = self.count+1
+        if len(self.buffer) >= self.chunk:
+            self._Spill()
+
+    def _Spill(self):
+
+        self.buffer.sort()
+        handle, path = tempfile.mkstemp(suffix='.run', dir=self.tmpdir)
+        pack = self.record.pack
+        with os.fdopen(handle, 'wb') as run:
+            for n in range(0, len(self.buffer), 65536):
+                run.write(b''.join(pack(*record) for record in self.buffer[n:n+65536]))
+        self.runs.append(path)
+        self.buffer = []
+
+    def _Read(self, path, block):
+
+        with open(path, 'rb') as run:
+            data = run.read(block)
+            while data:
+                yield from self.record.iter_unpack(data)
+                data = run.read(block)
+        os.remove(path)
+
+    def __iter__(self):
+
+        if len(self.runs) == 0:
+            self.buffer.sort()
+            return iter(self.buffer)
+        if len(self.buffer) > 0:
+            self._Spill()
+        block = self.record.size * max(64, self.memory // (2*len(self.runs)*self.record.size))
+
+        return heapq.merge(*[self._Read(path, block) for path in self.runs])
+
+class StageTable:
+
+    """Columnar table of a single stage: structure number, HADDOCK score and, for it0, the index of the input
+       complex in the InputCombinations of the run"""
+
+    def __init__(self):
+
+        self.number = array('i')
+        self.score = array('d')
+        self.complex = array('i')
+
+    def __len__(self):
+
+        return len(self.number)
+
+    def Append(self, number, score):
+
+        self.number.append(number)
+        self.score.append(score)
+
+    def Take(self, order):
+
+        """New table with the rows in order"""
+
+        table = StageTable()
+        table.number = Take(self.number, order)
+        table.score = Take(self.score, order)
+        if len(self.complex) > 0:
+            table.complex = Take(self.complex, order)
+
+        return table
+
+class LineageTable:
+
+    """Resolved lineage of a run in columnar form. A row holds the index of its it0, it1 and water structure in
+       the stage tables, -1 masks a stage the structure never reached. Rows are formatted on access as
+       (complex, it0, hscoreit0, it1, hscoreit1, water, hscorew) with 0 for masked stages"""
+
+    COLUMNS = ('complex', 'it0', 'hscoreit0', 'it1', 'hscoreit1', 'water', 'hscorew')
+
+    def __init__(self, complexes, it0, it1, water, rundir=''):
+
+        self.complexes = complexes
+        self.stages = (it0, it1, water)
+        self.rows = (array('i'), array('i'), array('i'))
+        self.rundir = rundir
+
+    def __len__(self):
+
+        return len(self.rows[0])
+
+    def __iter__(self):
+
+        for n in range(len(self)):
+            yield self[n]
+
+    def __getitem__(self, n):
+
+        if isinstance(n, slice):
+            return [self[k] for k in range(*n.indices(len(self)))]
+
+        it0 = self.rows[0][n]
+        row = [self.complexes[self.stages[0].complex[it0]] if it0 >= 0 else '']
+        for rows, table in zip(self.rows, self.stages):
+            if rows[n] >= 0:
+                row.extend((table.number[rows[n]], table.score[rows[n]]))
+            else:
+                row.extend((0, 0.0))
+
+        return tuple(row)
+
+    def Append(self, it0, it1, water):
+
+        self.rows[0].append(it0)
+        self.rows[1].append(it1)
+        self.rows[2].append(water)
+
+    def Head(self, n):
+
+        """Table with the first n rows, sharing the stage tables"""
+
+        table = LineageTable(self.complexes, *self.stages, rundir=self.rundir)
+        table.rows = tuple(rows[0:n] for rows in self.rows)
+
+        return table
+
+    def Index(self):
+
+        """Per stage a structure number -> row dictionary, the first row of a structure number wins"""
+
+        index = {}
+        for lib, rows, table in zip(STAGES, self.rows, self.stages):
+            index[lib] = {}
+            for n, row in enumerate(rows):
+                if row >= 0:
+                    index[lib].setdefault(table.number[row], n)
+
+        return index
+
+    def ComplexIndex(self):
+
+        """Index of the input complex of every row in complexes, -1 for rows without it0 structure"""
+
+        return array('i', [self.stages[0].complex[it0] if it0 >= 0 else -1 for it0 in self.rows[0]])
+
+    def Column(self, name):
+
+        """Values of one column (see COLUMNS) in row order. The complex column is a list of strings, the others are
+           typed arrays with 0 for masked stages"""
+
+        if name == 'complex':
+            return [self.complexes[self.stages[0].complex[it0]] if it0 >= 0 else '' for it0 in self.rows[0]]
+
+        stage = (self.COLUMNS.index(name)-1) // 2
+        values = getattr(self.stages[stage], 'number' if name in STAGES else 'score')
+
+        return array(values.typecode, [values[n] if n >= 0 else 0 for n in self.rows[stage]])
+
+    def Columns(self):
+
+        """Dictionary of all columns"""
+
+        return dict((name, self.Column(name)) for name in self.COLUMNS)
+
+    def ToDataFrame(self):
+
+        """The lineage as pandas DataFrame, requires pandas"""
+
+        import pandas
+        return pandas.DataFrame(self.Columns(), columns=self.COLUMNS)
+
+    def Header(self, query=False):
+
+        """The traceback.list header for this table"""
+
+        return TracebackHeader(self.rundir, [len(table) for table in self.stages], query=query)
+
+    def Lines(self):
+
+        """Generator over the traceback.list text, the header followed by one fixed width line per row"""
+
+        yield self.Header()
+        for row in self:
+            yield ROWFORMAT % row
+
+class StructureTraceback:
+
+    """Traceback any structure within a run directory all the way back to the individual components that
+       were used in the docking"""
+
+    def __init__(self, bulk=True, profile=None):
+
+        self.bulk = bulk
+        self.profile = profile or TracebackProfile()
+        self.bodies = []
+        self.complex_list = InputCombinations(self.bodies)
+
+        self.fileit0_list = StageTable()
+        self.fileit1_list = StageTable()
+        self.filew_list = StageTable()
+        self.query = []
+        self.cache = None
+        self.index = None
+
+    def _Sources(self, stage):
+
+        """The file lists a stage is parsed from"""
+
+        begin = BeginLists(os.path.join(self.rundir, 'begin'))
+        if stage == 'begin':
+            return begin
+        if stage == 'it0':
+            return [FindFile(os.path.join(self.rundir, 'structures', 'it0', 'file.list'))] + begin
+        if stage == 'it1':
+            return [FindFile(os.path.join(self.rundir, 'structures', 'it1', 'file.list'))]
+        if stage == 'water':
+            for filelist in ('file.list_all', 'file.list'):
+                path = FindFile(os.path.join(self.rundir, 'structures', 'it1', 'water', filelist))
+                if os.path.isfile(path):
+                    return [path]
+            return []
+        return self._Sources('it0') + self._Sources('it1') + self._Sources('water')
+
+    def _CacheLoad(self, stage):
+
+        """The data _CacheStore stored for stage, rebuilt from its values and columns"""
+
+        if self.cache == None:
+            return None
+        try:
+            cached = self.cache.Load(stage, self._Sources(stage))
+        except (sqlite3.Error, OSError) as error:
+            self._CacheFailed(error)
+            return None
+        if cached == None:
+            return None
+
+        values, columns = cached
+        if stage == 'begin':
+            return values
+        tables = []
+        for n in range(0, len(columns)-3 if stage == 'lineage' else len(columns), 3):
+            table = StageTable()
+            table.number, table.score, table.complex = columns[n:n+3]
+            tables.append(table)
+        if stage in STAGES:
+            return tables[0], values
+        lineage = LineageTable(InputCombinations(values['bodies']), *tables, rundir=values['rundir'])
+        lineage.rows = tuple(columns[9:12])
+
+        return tuple(values['counts']) + (lineage,)
+
+    def _CacheStore(self, stage, data):
+
+        """Cache the bodies (begin), a (StageTable, count) pair (it0, it1, water) or the lineage as (counts...,
+           LineageTable)"""
+
+        if self.cache == None:
+            return
+        if stage == 'begin':
+            values, columns = data, ()
+        elif stage in STAGES:
+            values, columns = data[1], (data[0].number, data[0].score, data[0].complex)
+        else:
+            lineage = data[3]
+            values = {'counts': data[0:3], 'bodies': lineage.complexes.bodies, 'rundir': lineage.rundir}
+            columns = [column for table in lineage.stages for column in (table.number, table.score, table.complex)]
+            columns.extend(lineage.rows)
         try:
-            return float(base3)
-        except:
-            return float((base3.split('w'))[0])
+            self.cache.Store(stage, self._Sources(stage), values, columns)
+        except (sqlite3.Error, OSError) as error:
+            self._CacheFailed(error)
+
+    def _CacheFailed(self, error):
+
+        """Carry on without cache when traceback.cache can not be read or written, e.g. in a read-only run"""
+
+        log.warning("    * WARNING: traceback.cache of %s not usable, tracing without cache: %s" % (self.rundir, error))
+        if self.cache != None:
+            self.cache.Close()
+            self.cache = None
+
 
     def _SortList(self, inlist=None,sortid=None):
 
-        keydir = {}
-        for n in inlist:
-            keydir[n[sortid]] = n
+        """Stable sort of a stage table on column sortid (low->high)"""
 
-        nameKeys = list(keydir.keys())
-        nameKeys.sort()
+        return inlist.Take(Argsort(getattr(inlist, sortid)))
 
-        new = []
-        for n in nameKeys:
-            new.append(keydir[n])
+    def _IndexStage(self, inlist=None):
 
-        return new
+        """Build a structure number -> row index for a stage table"""
 
-    def _SortonIndex(self, inlist=None, indexlist=None, index=False):
+        return dict(zip(inlist.number, range(len(inlist))))
 
-        indexnr = []
-        for n in indexlist:
-            indexnr.append(n[0])
+    def ResolveLineage(self):
 
-        tmp1 = []
-        tmplist = copy.deepcopy(inlist)
+        """Resolve the water->it1->it0->input chain using one structure number index per stage. The lineage rows
+           are stored in output order: all water structures (score low->high), the it1 structures not refined in
+           water and finally the it0 structures not refined in it1"""
 
-        if index == False:
-            for n in indexnr:
-                for k in tmplist:
-                    if n == k[0]:
-                        tmp1.append(k)
-                        tmplist.remove(k)
+        it0rank = Argsort(self.fileit0_list.score)   #it1 structure n is refined from the n-th best it0
+        it1index = self._IndexStage(inlist=self.fileit1_list)
 
-        if index == True:
-            for n in indexnr:
-                tmp1.append(inlist[int(n)-1])
-            for n in tmplist:
-                if n in tmp1:
-                    tmplist.remove(n)
-                else:
-                    pass
+        self.lineage = LineageTable(self.complex_list, self.fileit0_list, self.fileit1_list, self.filew_list, rundir=self.rundir)
+        usedit0 = bytearray(len(self.fileit0_list))
+        usedit1 = bytearray(len(self.fileit1_list))
 
-        return tmp1+tmplist
+        def parent(it1):
+            if it1 < 0 or not 0 < self.fileit1_list.number[it1] <= len(it0rank):
+                return -1
+            it0 = it0rank[self.fileit1_list.number[it1]-1]
+            usedit0[it0] = 1
+            return it0
 
-    def _FillList(self):
+        for water, number in enumerate(self.filew_list.number):
+            it1 = it1index.get(number, -1)
+            if it1 >= 0:
+                usedit1[it1] = 1
+            self.lineage.Append(parent(it1), it1, water)
 
-        lenit0 = len(self.fileit0_list)
-        lenit1 = len(self.fileit1_list)
-        lenw = len(self.filew_list)
+        for it1 in range(len(self.fileit1_list)):
+            if not usedit1[it1]:
+                self.lineage.Append(parent(it1), it1, -1)
 
-        tmpit1 = []
-        while lenit1 < lenit0:
-            tmpit1.append([0.0,0.0])
-            lenit1 = lenit1+1
+        for it0 in it0rank:
+            if not usedit0[it0]:
+                self.lineage.Append(it0, -1, -1)
 
-        tmpw = []
-        while lenw < lenit0:
-            tmpw.append([0.0,0.0])
-            lenw = lenw+1
+        self.index = None   #built on first use by LineageIndex
 
-        self.fileit1_list = self.fileit1_list+tmpit1
-        self.filew_list = self.filew_list+tmpw
+    def SelectLineage(self, stage='water', top=None, maxscore=None):
 
-    def IDStructures(self, filelist=None):
+        """Resolve the lineage of only the top best structures and/or the structures scoring at most maxscore in
+           stage, best first. The stage file lists are parsed but not sorted: the selection is a partial one and
+           the it0 ranking is only resolved as far as the selected structures need it"""
 
-        currdir = os.getcwd()
-        base,ext = os.path.split(currdir)
-
-        if ext == 'it0':
-            lib = 'it0'
-        elif ext == 'it1':
-            lib = 'it1'
-        elif ext == 'water':
-            lib = 'water'
+        tables = {}
+        for lib in STAGES:
+            sources = self._Sources(lib)
+            if len(sources) > 0 and os.path.isfile(sources[0]):
+                tables[lib] = ParseFileList(sources[0], bulk=self.bulk)
+            elif lib == 'water':
+                tables[lib] = StageTable()
+            else:
+                raise TracebackError("No file.list found in %s directory. Nothing to trace means stop" % lib)
+        it0, it1, water = tables['it0'], tables['it1'], tables['water']
+
+        selection = Smallest(tables[stage].score, count=top, maximum=maxscore, tiebreak=it0.number if stage == 'it0' else None)
+        rows = dict((lib, array('i', [-1]*len(selection))) for lib in STAGES)
+        rows[stage] = selection
+
+        if stage == 'water':
+            it1index = self._IndexStage(inlist=it1)
+            rows['it1'] = array('i', [it1index.get(water.number[n], -1) for n in selection])
+        if stage in ('water', 'it1'):
+            #it1 structure n is refined from the n-th best it0, only rank as many it0 structures as needed
+            ranks = [it1.number[n] for n in rows['it1'] if n >= 0 and 0 < it1.number[n] <= len(it0)]
+            it0rank = Smallest(it0.score, count=max(ranks or [0]), tiebreak=it0.number)
+            for k, n in enumerate(rows['it1']):
+                if n >= 0 and 0 < it1.number[n] <= len(it0rank):
+                    rows['it0'][k] = it0rank[it1.number[n]-1]
+        if stage == 'it0':
+            #the selection holds the best it0 structures, so their rank is their position
+            it1index = self._IndexStage(inlist=it1)
+            rows['it1'] = array('i', [it1index.get(rank+1, -1) for rank in range(len(selection))])
+        if stage in ('it0', 'it1'):
+            #a water structure is refined from the last it1 structure with its number, as in ResolveLineage
+            if stage == 'it1':
+                it1index = self._IndexStage(inlist=it1)
+            windex = {}
+            for n, number in enumerate(water.number):
+                windex.setdefault(number, n)
+            rows['water'] = array('i', [windex.get(it1.number[n], -1) if n >= 0 and it1index[it1.number[n]] == n else -1
+                                        for n in rows['it1']])
+
+        #Compact stage tables with just the selected rows, it0 gets the input complex from its structure number rank
+        stages = []
+        for lib in STAGES:
+            used = array('i', sorted(set(n for n in rows[lib] if n >= 0)))
+            position = dict(zip(used, range(len(used))))
+            stages.append(tables[lib].Take(used))
+            rows[lib] = array('i', [position.get(n, -1) for n in rows[lib]])
+            if lib == 'it0':
+                positions = StablePositions(it0.number, used)
+        stages[0].complex = array('i', [position % len(self.complex_list) for position in positions])
+
+        self.nrstrucit0, self.nrstrucit1, self.nrstrucw = len(it0), len(it1), len(water)
+        self.lineage = LineageTable(self.complex_list, *stages, rundir=self.rundir)
+        for k in range(len(selection)):
+            self.lineage.Append(rows['it0'][k], rows['it1'][k], rows['water'][k])
+        self.index = None
+
+    def TraceExternal(self, memory=256*2**20, tmpdir=None):
+
+        """Bounded memory version of Trace for runs whose stages do not fit in memory. The file lists are read
+           line by line into ExternalSorts sharing about memory bytes, temporary runs go to a directory in tmpdir.
+           it0 is ranked on score and the water->it1->it0 chain is resolved as streaming merge joins on structure
+           number. The rows are then available, in Trace order, from ExternalRows"""
+
+        self.GetStartStruc()
+        sources = dict((lib, self._Sources(lib)) for lib in STAGES)
+        for lib in ('it0', 'it1'):
+            if not os.path.isfile(sources[lib][0]):
+                raise TracebackError("No file.list found in %s directory. Nothing to trace means stop" % lib)
+
+        self.tmpdir = tempfile.mkdtemp(prefix='traceback.', dir=tmpdir)
+        share = memory // 6   #at most six sorts hold their buffer at the same time, during the merge join
+        log.info("    * Bounded memory traceback using %.0f MB, temporary files in %s" % (memory/2.0**20, self.tmpdir))
+
+        stages = {}
+        for lib in STAGES:
+            with self.profile.Phase('Sort%s' % lib.capitalize()) as phase:
+                stages[lib] = ExternalSort('<qqd', share, self.tmpdir)   #(number, line, score)
+                for filelist in sources[lib][0:1]:
+                    for line, (number, score, name) in enumerate(IterFileList(filelist)):
+                        stages[lib].Add((number, line, score))
+                phase['rows'] = len(stages[lib])
+        self.nrstrucit0, self.nrstrucit1, self.nrstrucw = [len(stages[lib]) for lib in STAGES]
+        if self.nrstrucw == 0:
+            log.warning("    No file.list of file.list_all found in water refinement directory. Only traceback from it1 to it0")
+
+        #Rank it0 on score, ties on the position in structure number order that also gives the input complex
+        with self.profile.Phase('RankIt0') as phase:
+            ranked = ExternalSort('<dqq', share, self.tmpdir)   #(score, position, number)
+            for position, (number, line, score) in enumerate(stages['it0']):
+                ranked.Add((score, position, number))
+            phase['rows'] = len(ranked)
+
+        with self.profile.Phase('MergeJoin') as phase:
+            self.external = (ExternalSort('<dqqqdqdq', share, self.tmpdir),   #water rows (score, line, number, it1, it0, complex)
+                             ExternalSort('<qqdqdq', share, self.tmpdir),     #it1 rows without water (line, number, score, it0, complex)
+                             ExternalSort('<qqdq', share, self.tmpdir))       #it0 rows without it1 (rank, number, score, complex)
+            children = itertools.groupby(self._JoinParents(ranked, stages['it1'], self.external[2]), key=lambda record: record[0])
+            number1, group1 = next(children, (None, None))
+            for number, structures in itertools.groupby(stages['water'], key=lambda record: record[0]):
+                while number1 != None and number1 < number:
+                    for record in group1:
+                        self.external[1].Add(record[1:2] + record[0:1] + record[2:])
+                    number1, group1 = next(children, (None, None))
+                it1 = (0, 0.0, 0, 0.0, -1)
+                if number1 == number:
+                    group1 = list(group1)
+                    for record in group1[:-1]:   #like the it1 index of ResolveLineage, the last duplicate is matched
+                        self.external[1].Add(record[1:2] + record[0:1] + record[2:])
+                    it1 = group1[-1][0:1] + group1[-1][2:]
+                    number1, group1 = next(children, (None, None))
+                for record in structures:
+                    self.external[0].Add((record[2], record[1], record[0]) + it1)
+            while number1 != None:
+                for record in group1:
+                    self.external[1].Add(record[1:2] + record[0:1] + record[2:])
+                number1, group1 = next(children, (None, None))
+            phase['rows'] = sum(len(rows) for rows in self.external)
+
+    def _JoinParents(self, ranked, it1, unused):
+
+        """Merge join of the it1 structures, on number, with the it0 ranking: it1 structure n is refined from
+           the n-th best it0. Yields (number, line, score, it0 number, it0 score, complex) per it1 structure with
+           complex -1 without parent, the it0 structures without it1 child are added to unused in rank order"""
+
+        nrcomplex = len(self.complex_list)
+        ranks = enumerate(ranked, 1)
+        rank, parent = next(ranks, (0, None))
+        matched = False
+        for number, line, score in it1:
+            while parent != None and rank < number:
+                if matched == False:
+                    unused.Add((rank, parent[2], parent[0], parent[1] % nrcomplex))
+                rank, parent = next(ranks, (0, None))
+                matched = False
+            if parent != None and rank == number:
+                matched = True
+                yield number, line, score, parent[2], parent[0], parent[1] % nrcomplex
+            else:
+                yield number, line, score, 0, 0.0, -1
+        while parent != None:
+            if matched == False:
+                unused.Add((rank, parent[2], parent[0], parent[1] % nrcomplex))
+            rank, parent = next(ranks, (0, None))
+            matched = False
+
+    def ExternalRows(self, longout=False):
+
+        """Generator over the rows resolved by TraceExternal formatted as LineageTable rows. Without longout only
+           the water refined structures. The rows can be iterated once"""
+
+        complexes = self.complex_list
+        for score, line, number, it1, it1score, it0, it0score, index in self.external[0]:
+            yield (complexes[index] if index >= 0 else '', it0, it0score, it1, it1score, number, score)
+        if longout == True:
+            for line, number, score, it0, it0score, index in self.external[1]:
+                yield (complexes[index] if index >= 0 else '', it0, it0score, number, score, 0, 0.0)
+            for rank, number, score, index in self.external[2]:
+                yield (complexes[index], number, score, 0, 0.0, 0, 0.0)
+
+    def RemoveTemporary(self):
+
+        """Remove the temporary files of TraceExternal"""
+
+        if getattr(self, 'tmpdir', None) != None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+
+    def _ParseID(self, structure, stage=None):
+
+        """Return (stage, structure number) for a structure identifier. Accepted are (stage, number) pairs,
+           'stage:name' strings and structure names or paths like it1/water/complex_12w.pdb. The stage is taken
+           from the identifier, the directory the structure is in, the 'w' suffix of water structures or stage"""
+
+        if isinstance(structure, (tuple, list)):
+            return structure[0], float(structure[1])
+
+        structure = structure.strip()
+        lib, sep, name = structure.partition(':')
+        if sep and lib in STAGES:
+            structure = name
         else:
-            print("    * ERROR: Structure not present in either it0, it1 or water directory")
-            sys.exit(0)
+            lib = os.path.basename(os.path.dirname(structure))
+
+        number = os.path.splitext(os.path.basename(Uncompressed(structure)))[0].split('_')[-1]
+        if number.endswith('w'):
+            number = number[:-1]
+            if lib not in STAGES:
+                lib = 'water'
+        if lib not in STAGES:
+            lib = stage
+
+        return lib, float(number)
+
+    def IDStructures(self, filelist=None, stage=None):
+
+        """Register structures to report on with ReportQuery. Structures without stage information in their name
+           or path are taken from stage, or from the directory the process runs in if that is a stage directory"""
+
+        if stage == None:
+            base,ext = os.path.split(os.getcwd())
+            if ext in STAGES:
+                stage = ext
 
-        tmp = []
         for n in filelist:
             try:
-                base = n.split('_')[1]
-                tmp.append(float(base)[0])
-            except:
-                base = n.split('_')[1]
-                tmp.append(float(base.split('w')[0]))
+                lib, number = self._ParseID(n, stage=stage)
+            except ValueError:
+                raise TracebackError("Could not get a structure number from %s" % n)
+            if lib == None:
+                raise TracebackError("Structure %s not present in either it0, it1 or water directory" % n)
+            self.query.append((lib, number))
 
-        self.query[lib] = tmp
+    def LineageIndex(self):
+
+        """Per stage structure number -> lineage row dictionary (see LineageTable.Index). Built on first use:
+           writing the lineage does not need it and building it dominates loading a cached lineage"""
+
+        if self.index == None:
+            self.index = self.lineage.Index()
+
+        return self.index
+
+    def QueryStructures(self, structures=None, stage=None):
+
+        """Generator resolving any number of structure identifiers (see _ParseID) from any stage against the
+           lineage index. Yields (stage, structure number, lineage row) as each one resolves, the row is None
+           for structures that are not part of the run"""
+
+        index = self.LineageIndex()
+        for n in structures:
+            lib, number = self._ParseID(n, stage=stage)
+            row = index.get(lib, {}).get(number)
+            if row == None:
+                yield lib, number, None
+            else:
+                yield lib, number, self.lineage[row]
 
     def Rundir(self, paramdict):
         """
@@ -294,16 +1851,14 @@ class StructureTraceback:
         """
         if paramdict['inputdir'] and os.path.exists(paramdict['inputdir']):
             if not os.path.exists(os.path.join(os.path.abspath(paramdict['inputdir']), 'begin')):
-                print("    * ERROR: No begin directory in {}".format(paramdict['inputdir']))
-                sys.exit(0)
+                raise TracebackError("No begin directory in {}".format(paramdict['inputdir']))
             else:
                 self.rundir = os.path.abspath(paramdict['inputdir'])
         elif not paramdict['inputdir']:
             self.rundir = os.getcwd()
         else:
-            print("    * ERROR: Could not find directory {}".format(paramdict['inputdir']))
-            sys.exit(0)
-        print("    * Working directory: {}".format(self.rundir))
+            raise TracebackError("Could not find directory {}".format(paramdict['inputdir']))
+        log.info("    * Working directory: {}".format(self.rundir))
 
     def GetBasedir(self):
 
@@ -324,210 +1879,195 @@ class StructureTraceback:
             count = count+1
 
         if len(rundir) == 0:
-            print("    * ERROR: No run directory found in current path, quit program")
-            sys.exit(0)
+            raise TracebackError("No run directory found in current path, quit program")
         else:
             self.rundir = rundir
 
+    def Trace(self, cache=False):
+
+        """Read all stages of the run and resolve the lineage. With cache the lineage is served from the
+           traceback.cache file in the run directory and only the stages whose file lists changed are parsed"""
+
+        if cache == True:
+            try:
+                self.cache = TracebackCache(self.rundir)
+            except (sqlite3.Error, OSError) as error:
+                self._CacheFailed(error)
+
+        cached = self._CacheLoad('lineage')
+        if cached != None:
+            self.nrstrucit0, self.nrstrucit1, self.nrstrucw, self.lineage = cached
+            self.index = None
+        else:
+            with self.profile.Phase('GetStartStruc') as phase:
+                self.GetStartStruc()
+                phase['rows'] = len(self.complex_list)
+            with self.profile.Phase('GetWatStructures') as phase:
+                self.GetWatStructures()
+                phase['rows'] = self.nrstrucw
+            with self.profile.Phase('GetIt1Structures') as phase:
+                self.GetIt1Structures()
+                phase['rows'] = self.nrstrucit1
+            with self.profile.Phase('GetIt0Structures') as phase:
+                self.GetIt0Structures()
+                phase['rows'] = self.nrstrucit0
+            with self.profile.Phase('ResolveLineage') as phase:
+                self.ResolveLineage()
+                phase['rows'] = len(self.lineage)
+            self._CacheStore('lineage', (self.nrstrucit0, self.nrstrucit1, self.nrstrucw, self.lineage))
+
+        if self.cache != None:
+            self.cache.Close()
+            self.cache = None
+
     def GetStartStruc(self):
 
         """Getting all starting structures from the file_X.list files in the begin directory"""
 
-        begindir = self.rundir+'/begin'
-        os.chdir(begindir)
-        print("Using begin directory:", begindir)
+        cached = self._CacheLoad('begin')
+        if cached != None:
+            self.bodies = cached
+            self.complex_list = InputCombinations(self.bodies)
+            return
 
-        files = ['file_1.list','file_2.list']
-        files2 = ['file_1_list','file_2_list']
-        print("files created:", files)
+        begindir = os.path.join(self.rundir, 'begin')
+        log.debug("    * Using begin directory: %s" % begindir)
 
-        for file_list in files:
-            print("executing the outter for loop")
+        self.bodies = []
+        for file_list in BeginLists(begindir):
             if os.path.isfile(file_list):
-                
-                with open(file_list, 'r') as fileX:
-                    lines = fileX.readlines()
 
-                    for line in lines:
-                        print("executing the inner for loop")
-                        extracted_filename = (line.split(':'))[-1].strip('"\n')
-                        getattr(self, files2[files.index(file_list)]).append(extracted_filename)
-                        print("Extracted filename:", extracted_filename)
-            else:
-                pass
-
-        """"Make combinations equal to generate_complex.inp and store in complex_list"""
-        print(self.file_1_list)
-        if len(self.file_1_list) > 0:
-            for structureA in self.file_1_list:
-                if len(self.file_2_list) > 0:
-                    for structureB in self.file_2_list:
-                        self.complex_list.append(structureA + "/" + structureB)
-                        
-                else:
-                    self.complex_list.append(structureA)
-        else:
-            print("    * ERROR No starting structures found in the begin directory")
-            sys.exit(0)
+                with OpenFile(file_list, 'r') as fileX:
+                    structures = [(line.split(':'))[-1].strip('"\n') for line in fileX if line.strip()]
+                if len(structures) > 0:
+                    self.bodies.append(structures)
+                log.debug("    * %s: %s" % (os.path.basename(file_list), ' '.join(structures)))
+
+        """"Combinations equal to generate_complex.inp, formatted on demand by complex_list"""
+        if len(self.bodies) == 0:
+            raise TracebackError("No starting structures found in the begin directory")
+        self.complex_list = InputCombinations(self.bodies)
+
+        self._CacheStore('begin', self.bodies)
 
     def GetIt0Structures(self):
 
-        begindir = self.rundir+'/structures/it0'
-        os.chdir(begindir)
-
-        if os.path.isfile('file.list'):
-            fileit0 = open('file.list', 'r')
-            lines = fileit0.readlines()
-
-            for line in lines:
-                if line == '\n':
-                    pass
-                else:
-                    tmp = []
-                    tmp.append(self._FormatLine(line.split()[0]))
-                    tmp.append(float(line.split()[2]))
-                    self.fileit0_list.append(tmp)
-                    
+        cached = self._CacheLoad('it0')
+        if cached != None:
+            self.fileit0_list, self.nrstrucit0 = cached
+            return
+
+        filelist = FindFile(os.path.join(self.rundir, 'structures', 'it0', 'file.list'))
+
+        if os.path.isfile(filelist):
+            self.SetIt0Structures(ParseFileList(filelist, bulk=self.bulk))
         else:
-            print("    * ERROR: No file.list found in it0 directory. Nothing to trace means stop")
-            sys.exit(0)
+            raise TracebackError("No file.list found in it0 directory. Nothing to trace means stop")
 
-        self.nrstrucit0 = len(self.fileit0_list)
-        nrstrucbg = len(self.complex_list)
+        self._CacheStore('it0', (self.fileit0_list, self.nrstrucit0))
 
-        self.complex_list = self.complex_list * int((round(self.nrstrucit0/nrstrucbg))+1)
-        self.complex_list = self.complex_list[0:self.nrstrucit0]
+    def SetIt0Structures(self, table):
 
-        self.fileit0_list = self._SortList(inlist=self.fileit0_list,sortid=0) #first sort on structure number low->high
+        """Use the it0 structures in table as read from file.list"""
 
-        for n in range(len(self.complex_list)):			      #Match complex_list to it0 structures
-            self.fileit0_list[n].append(self.complex_list[n])
+        self.nrstrucit0 = len(table)
+        nrstrucbg = len(self.complex_list)
+
+        self.fileit0_list = self._SortList(inlist=table,sortid='number') #first sort on structure number low->high
 
-        self.fileit0_list = self._SortList(inlist=self.fileit0_list,sortid=1) #than sort on HADDOCK score low->high
-        self.fileit0_list = self._SortonIndex(inlist=self.fileit0_list,indexlist=self.fileit1_list,index=True) #Sort according to index it1
+        #Match complex_list to it0 structures, the input complexes are generated in turn
+        self.fileit0_list.complex = array('i', [n % nrstrucbg for n in range(self.nrstrucit0)])
 
     def GetIt1Structures(self):
 
-        begindir = self.rundir+'/structures/it1'
-        os.chdir(begindir)
-
-        if os.path.isfile('file.list'):
-            with open('file.list', 'r') as fileit1:
-                lines = fileit1.readlines()
-
-                for line in lines:
-                    if line == '\n':
-                        pass
-                    else:
-                        tmp = []
-                        tmp.append(self._FormatLine(line.split()[0]))
-                        tmp.append(float(line.split()[2]))
-                        self.fileit1_list.append(tmp)
-                        
+        cached = self._CacheLoad('it1')
+        if cached != None:
+            self.fileit1_list, self.nrstrucit1 = cached
+            return
+
+        filelist = FindFile(os.path.join(self.rundir, 'structures', 'it1', 'file.list'))
+
+        if os.path.isfile(filelist):
+            self.SetIt1Structures(ParseFileList(filelist, bulk=self.bulk))
         else:
-            print("    * ERROR: No file.list found in it1 directory. Nothing to trace means stop")
-            sys.exit(0)
+            raise TracebackError("No file.list found in it1 directory. Nothing to trace means stop")
+
+        self._CacheStore('it1', (self.fileit1_list, self.nrstrucit1))
+
+    def SetIt1Structures(self, table):
+
+        """Use the it1 structures in table as read from file.list"""
 
-        self.nrstrucit1 = len(self.fileit1_list)
-        self.fileit1_list = self._SortonIndex(inlist=self.fileit1_list,indexlist=self.filew_list,index=False) #Sort according to index W. This matches it1 to W
+        self.fileit1_list = table
+        self.nrstrucit1 = len(table)
 
     def GetWatStructures(self):
 
-        begindir = self.rundir+'/structures/it1/water'
-        os.chdir(begindir)
+        cached = self._CacheLoad('water')
+        if cached != None:
+            self.filew_list, self.nrstrucw = cached
+            return
 
-        if os.path.isfile('file.list_all'):
-            filew = file('file.list_all', 'r')
-            lines = filew.readlines()
-        else:
-            filew = open('file.list', 'r')
-            lines = filew.readlines()
+        table = StageTable()
+        for filelist in self._Sources('water'):
+            table = ParseFileList(filelist, bulk=self.bulk)
 
-        for line in lines:
-            if line == '\n':
-                pass
-            else:
-                tmp = []
-                tmp.append(self._FormatLine(line.split()[0]))
-                tmp.append(float(line.split()[2]))
-                self.filew_list.append(tmp)
+        self.SetWatStructures(table)
+        if self.nrstrucw == 0:
+            log.warning("    No file.list of file.list_all found in water refinement directory. Only traceback from it1 to it0")
 
-        self.nrstrucw = len(self.filew_list)
+        self._CacheStore('water', (self.filew_list, self.nrstrucw))
 
-        if self.nrstrucw > 0:
-            self.filew_list = self._SortList(inlist=self.filew_list,sortid=1) #Sort on HADDOCK score low->high.
-        else:
-            print("    No file.list of file.list_all found in water refinement directory. Only traceback from it1 to it0")
+    def SetWatStructures(self, table):
 
-    def WriteFile(self, verbose=False, longout=False):
+        """Use the water refined structures in table as read from file.list(_all)"""
 
-        os.chdir(self.rundir)
+        self.nrstrucw = len(table)
+        self.filew_list = self._SortList(inlist=table,sortid='score') #Sort on HADDOCK score low->high.
+
+    def WriteFile(self, verbose=False, longout=False, format='text', compress=None):
 
-        if verbose == True:
-            outfile = sys.stdout
-        else:
-            outfile = open('traceback.list', 'w')
-            print("    * Traceback information written to file 'traceback.list' in directory", self.rundir)
-
-        outfile.write('*****************************************************************************************************************\n')
-        outfile.write('Structure traceback information for run %s\n' % self.rundir)
-        outfile.write('Date/time: %s\n' % ctime())
-        outfile.write('Number of structures: %i in it0, %i in it1 and %i in water refinement\n' % (self.nrstrucit0,self.nrstrucit1,self.nrstrucw))
-        outfile.write('Sorting order: water(struct. nr.) matches it1 (struct. nr.) matches it0 (struct. nr.) matches input structures.\n')
-        outfile.write('*****************************************************************************************************************\n')
-        outfile.write('      complex                             it0      hscoreit0       it1      hscoreit1      water      hscorew\n')
         if longout == True:
-            self._FillList()
-            for n in range(len(self.fileit0_list)):
-                outfile.write('%35s%10.0f%15.4f%10.0f%15.4f%10.0f%15.4f\n' % (self.fileit0_list[n][2],self.fileit0_list[n][0],self.fileit0_list[n][1],
-                           self.fileit1_list[n][0],self.fileit1_list[n][1],self.filew_list[n][0],self.filew_list[n][1]))
+            rows = self.lineage
         else:
-            for n in range(len(self.filew_list)):
-                outfile.write('%35s%10.0f%15.4f%10.0f%15.4f%10.0f%15.4f\n' % (self.fileit0_list[n][2],self.fileit0_list[n][0],self.fileit0_list[n][1],
-                           self.fileit1_list[n][0],self.fileit1_list[n][1],self.filew_list[n][0],self.filew_list[n][1]))
+            rows = self.lineage.Head(self.nrstrucw)
 
-        if verbose == False:
-            outfile.close()
+        if verbose == True:
+            for line in rows.Lines():
+                sys.stdout.write(line)
         else:
-            pass
+            path = ExportLineage(rows, self.rundir, format=format, compress=compress)
+            log.info("    * Traceback information written to file '%s' in directory %s" % (os.path.basename(path), self.rundir))
 
-    def ReportQuery(self, verbose=False):
+    def WriteStream(self, verbose=False, longout=False, format='text', compress=None):
 
-        os.chdir(self.rundir)
+        """WriteFile for the rows resolved by TraceExternal, written as they are merged"""
+
+        header = TracebackHeader(self.rundir, (self.nrstrucit0, self.nrstrucit1, self.nrstrucw))
+        if verbose == True:
+            sys.stdout.write(header)
+            for row in self.ExternalRows(longout=longout):
+                sys.stdout.write(ROWFORMAT % row)
+        else:
+            path = ExportRows(self.ExternalRows(longout=longout), header, self.rundir, format=format, compress=compress)
+            log.info("    * Traceback information written to file '%s' in directory %s" % (os.path.basename(path), self.rundir))
+
+    def ReportQuery(self, verbose=False, compress=None):
 
         if verbose == True:
             outfile = sys.stdout
         else:
-            outfile = file('traceback.list', 'w')
-            print("    * Traceback information written to file 'traceback.list' in directory", self.rundir)
-
-        outfile.write('*****************************************************************************************************************\n')
-        outfile.write('Structure traceback information for run %s\n' % self.rundir)
-        outfile.write('Date/time: %s\n' % ctime())
-        outfile.write('Number of structures: %i in it0, %i in it1 and %i in water refinement\n' % (self.nrstrucit0,self.nrstrucit1,self.nrstrucw))
-        outfile.write('Sorting order: water(struct. nr.) matches it1 (struct. nr.) matches it0 (struct. nr.) matches input structures.\n')
-        outfile.write('*****************************************************************************************************************\n')
-        outfile.write('      complex                              it0      hscoreit0       it1      hscoreit1      water      hscorew\n')
-
-        if list(self.query.keys()) == ['water']:
-            for n in self.query['water']:
-                for k in self.filew_list:
-                    if n == k[0]:
-                        outfile.write("%35s%10.0f%15.4f%10.0f%15.4f%10.0f%15.4f\n" % (self.fileit0_list[self.filew_list.index(k)][2],self.fileit0_list[self.filew_list.index(k)][0],
-                                   self.fileit0_list[self.filew_list.index(k)][1],self.fileit1_list[self.filew_list.index(k)][0],self.fileit1_list[self.filew_list.index(k)][1],n,k[1]))
-        elif list(self.query.keys()) == ['it1']:
-            for n in self.query['it1']:
-                for k in self.fileit1_list:
-                    if n == k[0]:
-                        outfile.write("%35s%10.0f%15.4f%10.0f%15.4f%10.0f%15.4f\n" % (self.fileit0_list[self.fileit1_list.index(k)][2],self.fileit0_list[self.fileit1_list.index(k)][0],
-                                   self.fileit0_list[self.fileit1_list.index(k)][1],n,k[1],self.filew_list[self.fileit1_list.index(k)][0],self.filew_list[self.fileit1_list.index(k)][1]))
-        elif list(self.query.keys()) == ['it0']:
-            self._FillList()
-            for n in self.query['it0']:
-                for k in self.fileit0_list:
-                    if n == k[0]:
-                        outfilewrite("%35s%10.0f%15.4f%10.0f%15.4f%10.0f%15.4f\n" % (k[2],n,k[1],self.fileit1_list[self.fileit0_list.index(k)][0],self.fileit1_list[self.fileit0_list.index(k)][1],
-                                   self.filew_list[self.fileit0_list.index(k)][0],self.filew_list[self.fileit0_list.index(k)][1]))
+            filename = 'traceback.list' + ('.' + compress if compress else '')
+            outfile = OpenFile(os.path.join(self.rundir, filename), 'w')
+            log.info("    * Traceback information written to file '%s' in directory %s" % (filename, self.rundir))
+
+        outfile.write(self.lineage.Header(query=True))
+
+        for lib, number, row in self.QueryStructures(structures=self.query):
+            if row == None:
+                log.warning("    * WARNING: Structure %i not found in %s" % (number, lib))
+            else:
+                outfile.write(ROWFORMAT % row)
 
         if verbose == False:
             outfile.close()
@@ -541,7 +2081,7 @@ if __name__ == '__main__':
 
     """Parse command line arguments"""
     option_dict = CommandlineOptionParser().option_dict
-    print("Contents of option_dict:", option_dict)
+    log.debug("Contents of option_dict: %s" % option_dict)
     
     if 'input' in option_dict:
         inputlist = option_dict['input']
@@ -549,10 +2089,23 @@ if __name__ == '__main__':
         inputlist = None
 
     """Envoce main functions"""
-    PluginCore(option_dict, inputlist=option_dict['input'])
+    if option_dict['serve']:
+        try:
+            Serve(option_dict['runs'] or [option_dict['inputdir'] or os.getcwd()], option_dict['serve'], cache=option_dict['cache'])
+        except (TracebackError, OSError) as error:
+            log.error("    * ERROR: %s" % error)
+    elif option_dict['follow']:
+        try:
+            FollowRun(option_dict['inputdir'] or os.getcwd(), interval=option_dict['interval'], longout=option_dict['longout'], format=option_dict['format'], compress=option_dict['compress'])
+        except TracebackError as error:
+            log.error("    * ERROR: %s" % error)
+    elif option_dict['runs']:
+        TraceRuns(option_dict['runs'], workers=option_dict['workers'], longout=option_dict['longout'], merge=option_dict['merge'], cache=option_dict['cache'], format=option_dict['format'], profile=option_dict['profile'], compress=option_dict['compress'])
+    else:
+        PluginCore(option_dict, inputlist=option_dict['input'])
 
     """Say goodbye"""
-    print("--> Thanks for using PDBtraceback, bye")
+    log.info("--> Thanks for using PDBtraceback, bye")
     sys.exit(0)
 
 
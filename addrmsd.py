@@ -1,34 +1,479 @@
+import os
+import math
+import hashlib
+import sqlite3
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from PDBtraceback import ROWFORMAT, LineageTable, FindFile, OpenFile, StructureNumber, Uncompressed
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BACKBONE = ("N", "CA", "C", "O")
+METRICS = ("i-RMSD", "l-RMSD", "Fnat")
+
+
+class MetricError(Exception):
+    """Raised when structure metrics can not be computed"""
+
+
+def structure_key(name):
+    """Structure number for a structure name (complex_12w.pdb, PREVIT:complex_12.pdb, ...) or a plain number"""
+    if name.isdigit():
+        return int(name)
+    return StructureNumber(name)
+
+
+def traceback_numbers(fields):
+    """(it0, it1, water) structure numbers of a split traceback row, None for header lines"""
+    try:
+        return int(float(fields[-6])), int(float(fields[-4])), int(float(fields[-2]))
+    except (IndexError, ValueError):
+        return None
+
+
+def iter_metric_file(path):
+    """Generator over a per-structure metric file yielding (structure number, values). The column names of a
+    header line starting with # are yielded with None as structure number. Compressed files (.gz, .bz2) are
+    decompressed while reading."""
+    with OpenFile(path) as file:
+        for line in file:
+            if line.startswith("#"):
+                yield None, line.strip("#\n").split()[1:]
+                continue
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            try:
+                key = structure_key(fields[0])
+            except ValueError:
+                print(f"Warning: Skipping line without structure name in {path}: {line.strip()}")
+                continue
+            yield key, fields[1:]
+
+
+def column_names(path, columns, width):
+    """Column names from the metric file header, or named after the file when there is no usable header"""
+    if len(columns) == width:
+        return columns
+    name = os.path.splitext(os.path.basename(Uncompressed(path)))[0]
+    return [name] if width == 1 else [f"{name}_{n + 1}" for n in range(width)]
+
+
+class MetricTable:
+    """Whitespace separated per-structure metric file (i-RMSD.dat, l-RMSD.dat, fnat, ene-residue, ...) indexed
+    by structure number. The first column holds the structure name or number, the others the metric values.
+    A header line starting with # names the columns, otherwise they are named after the file."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.columns = []
+        self.values = {}
+
+        width = 0
+        for key, values in iter_metric_file(path) if path else ():
+            if key is None:
+                self.columns = self.columns or values
+            else:
+                self.values[key] = values
+                width = max(width, len(values))
+
+        self.columns = column_names(path, self.columns, width)
+
+    @classmethod
+    def from_values(cls, columns, values):
+        """Table of computed metrics, values maps structure numbers to one number per column (NaN for NA)"""
+        table = cls()
+        table.columns = list(columns)
+        for key, row in values.items():
+            table.values[key] = ["NA" if value != value else f"{value:.3f}" for value in row]
+        return table
+
+    def get(self, key):
+        """Metric values for a structure number, NA for structures missing from the file"""
+        values = self.values.get(key, [])
+        return values + ["NA"] * (len(self.columns) - len(values))
+
+    def write(self, path):
+        """Write the table as metric file with a # header, readable by MetricTable and annotate_stream"""
+        with OpenFile(path, "w") as file:
+            file.write("#struc " + " ".join(self.columns) + "\n")
+            for key in sorted(self.values):
+                file.write(f"{key} " + " ".join(self.values[key]) + "\n")
+
+
+def read_atoms(path):
+    """(atom keys, coordinates, heavy atom flags) of the ATOM records of the first model of a PDB file. A key is
+    (chain, residue number, insertion code, atom name); the segment id is used for the chain when the chain
+    column is empty, as in HADDOCK output. Only the first alternate location of an atom is kept."""
+    keys, coordinates, heavy = [], [], []
+    seen = set()
+    with OpenFile(path, "rb") as pdb:
+        for line in pdb:
+            if line.startswith(b"ENDMDL"):
+                break
+            if not line.startswith(b"ATOM  "):
+                continue
+            chain = (line[21:22].strip() or line[72:76].strip()).decode()
+            key = (chain, int(line[22:26]), line[26:27].decode(), line[12:16].strip().decode())
+            if key in seen:
+                continue
+            seen.add(key)
+            keys.append(key)
+            coordinates.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+            element = line[76:78].strip() or line[12:16].strip()[:1]
+            heavy.append(element != b"H")
+    return keys, coordinates, heavy
+
+
+def superpose(mobile, target):
+    """Batched Kabsch superposition of (models, atoms, 3) mobile onto (atoms, 3) target. Returns the rotations
+    (models, 3, 3) and the centroids of mobile and target, apply as (x - mobile centroid) @ R + target centroid."""
+    mobile_centroid = mobile.mean(axis=1, keepdims=True)
+    target_centroid = target.mean(axis=0)
+    covariance = numpy.einsum("mki,kj->mij", mobile - mobile_centroid, target - target_centroid)
+    u, _, vt = numpy.linalg.svd(covariance)
+    correction = numpy.ones((len(mobile), 3))
+    correction[:, 2] = numpy.sign(numpy.linalg.det(numpy.matmul(u, vt)))
+    return numpy.matmul(u * correction[:, None, :], vt), mobile_centroid, target_centroid
+
+
+def fitted_rmsd(models, target, fit, measure):
+    """RMSD over the atoms measure of every model after superposition on the atoms fit"""
+    rotation, mobile_centroid, target_centroid = superpose(models[:, fit], target[fit])
+    moved = numpy.matmul(models[:, measure] - mobile_centroid, rotation) + target_centroid
+    return numpy.sqrt(((moved - target[measure]) ** 2).sum(axis=2).mean(axis=1))
+
+
+class Reference:
+    """Reference complex for the CAPRI metrics. Interface residues (any heavy atom within interface_cutoff of
+    the other chain) and native residue contacts (within contact_cutoff) are determined once; models are
+    matched to the reference on atom keys (see read_atoms).
+
+    i-RMSD: backbone RMSD of the interface residues after fitting on them.
+    l-RMSD: ligand backbone RMSD after fitting on the receptor backbone.
+    Fnat:   fraction of the native residue contacts present in the model."""
+
+    def __init__(self, path, receptor="A", ligand="B", interface_cutoff=10.0, contact_cutoff=5.0):
+        if numpy is None:
+            raise MetricError("Computing structure metrics requires NumPy")
+
+        self.path = path
+        self.keys, coordinates, heavy = read_atoms(path)
+        self.coordinates = numpy.array(coordinates, dtype=float).reshape(-1, 3)
+        self.contact_cutoff = contact_cutoff
+        heavy = numpy.array(heavy, dtype=bool)
+        chains = numpy.array([key[0] for key in self.keys])
+        backbone = numpy.array([key[3] in BACKBONE for key in self.keys], dtype=bool)
+        residues = [key[:3] for key in self.keys]
+
+        receptor_atoms = numpy.flatnonzero((chains == receptor) & heavy)
+        ligand_atoms = numpy.flatnonzero((chains == ligand) & heavy)
+        if len(receptor_atoms) == 0 or len(ligand_atoms) == 0:
+            raise MetricError(f"Reference {path} has no atoms in chain {receptor} or {ligand}")
+
+        near_receptor = numpy.zeros(len(receptor_atoms), dtype=bool)
+        near_ligand = numpy.zeros(len(ligand_atoms), dtype=bool)
+        for start in range(0, len(receptor_atoms), 256):
+            close = self._close(self.coordinates, receptor_atoms[start:start + 256], ligand_atoms, interface_cutoff)
+            near_receptor[start:start + 256] = close.any(axis=1)
+            near_ligand |= close.any(axis=0)
+        interface = {residues[n] for n in receptor_atoms[near_receptor]} | {residues[n] for n in ligand_atoms[near_ligand]}
+        in_interface = numpy.array([residue in interface for residue in residues], dtype=bool)
+
+        self.interface = numpy.flatnonzero(in_interface & backbone)
+        self.receptor_backbone = numpy.flatnonzero((chains == receptor) & backbone)
+        self.ligand_backbone = numpy.flatnonzero((chains == ligand) & backbone)
+
+        # Heavy atoms of the interface residues, grouped per residue for the residue contact reduction
+        self.receptor_contact = numpy.array([n for n in receptor_atoms if in_interface[n]], dtype=int)
+        self.ligand_contact = numpy.array([n for n in ligand_atoms if in_interface[n]], dtype=int)
+        self.receptor_starts = self._residue_starts(self.receptor_contact, residues)
+        self.ligand_starts = self._residue_starts(self.ligand_contact, residues)
+        self.native = self._contacts(self.coordinates[None])[0]
+        if len(self.interface) == 0 or not self.native.any():
+            raise MetricError(f"No interface between chain {receptor} and {ligand} in reference {path}")
+
+        digest = hashlib.sha1()
+        with OpenFile(path, "rb") as file:
+            digest.update(file.read())
+        digest.update(repr((receptor, ligand, interface_cutoff, contact_cutoff)).encode())
+        self.signature = digest.hexdigest()
+        self.index = {key: n for n, key in enumerate(self.keys)}
+
+    @staticmethod
+    def _close(coordinates, first, second, cutoff):
+        """Boolean (first, second) matrix of the atom pairs within cutoff"""
+        difference = coordinates[first, None, :] - coordinates[None, second, :]
+        return (difference ** 2).sum(axis=2) <= cutoff * cutoff
+
+    @staticmethod
+    def _residue_starts(atoms, residues):
+        return numpy.array([k for k in range(len(atoms)) if k == 0 or residues[atoms[k]] != residues[atoms[k - 1]]], dtype=int)
+
+    def _contacts(self, models):
+        """(models, receptor residues, ligand residues) residue contact matrices of the interface residues, one
+        model at a time to bound the size of the atom distance matrix"""
+        contacts = []
+        for model in models:
+            close = self._close(model, self.receptor_contact, self.ligand_contact, self.contact_cutoff).astype(numpy.uint8)
+            close = numpy.maximum.reduceat(close, self.receptor_starts, axis=0)
+            contacts.append(numpy.maximum.reduceat(close, self.ligand_starts, axis=1))
+        return numpy.array(contacts, dtype=bool)
+
+    def model_coordinates(self, path):
+        """Coordinates of a model PDB in reference atom order, None when reference atoms are missing"""
+        keys, coordinates, _ = read_atoms(path)
+        order = [self.index.get(key, -1) for key in keys]
+        model = numpy.full(self.coordinates.shape, numpy.nan)
+        selected = [n for n, k in enumerate(order) if k >= 0]
+        model[[order[n] for n in selected]] = numpy.array(coordinates, dtype=float).reshape(-1, 3)[selected]
+        if numpy.isnan(model).any():
+            return None
+        return model
+
+    def metrics(self, models):
+        """(i-RMSD, l-RMSD, Fnat) arrays for a (models, atoms, 3) batch of model coordinates"""
+        irmsd = fitted_rmsd(models, self.coordinates, self.interface, self.interface)
+        lrmsd = fitted_rmsd(models, self.coordinates, self.receptor_backbone, self.ligand_backbone)
+        fnat = (self._contacts(models) & self.native).sum(axis=(1, 2)) / float(self.native.sum())
+        return irmsd, lrmsd, fnat
+
+
+def metrics_batch(reference, paths):
+    """Worker: metrics of a batch of model PDBs as {path: (i-RMSD, l-RMSD, Fnat)}, NaN for models that do not
+    have all reference atoms"""
+    results = {}
+    models, valid = [], []
+    for path in paths:
+        model = reference.model_coordinates(path)
+        if model is None:
+            results[path] = (float("nan"),) * len(METRICS)
+        else:
+            models.append(model)
+            valid.append(path)
+    if models:
+        for path, values in zip(valid, zip(*reference.metrics(numpy.array(models)))):
+            results[path] = tuple(float(value) for value in values)
+    return results
+
+
+class MetricCache:
+    """SQLite cache of computed metrics per model PDB, valid while the size and mtime of the PDB and the
+    reference signature (reference file and interface definition) are unchanged. The metrics are plain REAL
+    columns, a NaN is stored as NULL"""
+
+    VERSION = 2
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+            self.db.execute("DROP TABLE IF EXISTS metrics")
+            self.db.execute(f"PRAGMA user_version = {self.VERSION}")
+        self.db.execute("CREATE TABLE IF NOT EXISTS metrics (path TEXT, reference TEXT, stat TEXT, irmsd REAL, lrmsd REAL, fnat REAL, "
+                        "PRIMARY KEY (path, reference))")
+
+    @staticmethod
+    def _stat(path):
+        info = os.stat(path)
+        return f"{info.st_size} {info.st_mtime_ns}"
+
+    def load(self, paths, reference):
+        """Cached metrics of the unchanged paths"""
+        cached = {}
+        for path in paths:
+            entry = self.db.execute("SELECT stat, irmsd, lrmsd, fnat FROM metrics WHERE path = ? AND reference = ?",
+                                    (os.path.abspath(path), reference.signature)).fetchone()
+            if entry is not None and entry[0] == self._stat(path):
+                cached[path] = tuple(math.nan if value is None else float(value) for value in entry[1:])
+        return cached
+
+    def store(self, results, reference):
+        self.db.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?)",
+                            [(os.path.abspath(path), reference.signature, self._stat(path)) + tuple(float(value) for value in values)
+                             for path, values in results.items()])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def compute_metrics(reference, paths, workers=None, cache_file=None, batch_size=64):
+    """i-RMSD, l-RMSD and Fnat of the model PDBs in paths against reference as {path: (i-RMSD, l-RMSD, Fnat)}.
+    Models are processed in batches over a process pool; with cache_file results are reused for PDBs whose
+    size and mtime did not change. A cache file that can not be opened or written is reported and skipped."""
+    cache, results = None, {}
+    if cache_file:
+        try:
+            cache = MetricCache(cache_file)
+            results = cache.load(paths, reference)
+        except (sqlite3.Error, OSError) as error:
+            print(f"Warning: Not using metric cache {cache_file}: {error}")
+            cache = None
+    missing = [path for path in paths if path not in results]
+
+    if missing:
+        batches = [missing[n:n + batch_size] for n in range(0, len(missing), batch_size)]
+        computed = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for batch in pool.map(metrics_batch, [reference] * len(batches), batches):
+                computed.update(batch)
+        if cache:
+            try:
+                cache.store(computed, reference)
+            except (sqlite3.Error, OSError) as error:
+                print(f"Warning: Could not update metric cache {cache_file}: {error}")
+        results.update(computed)
+
+    if cache:
+        cache.close()
+    return results
+
+
 class DataManipulator:
+    """Works on a traceback.list file or directly on the LineageTable returned by PDBtraceback.LoadLineage"""
+
     def __init__(self, traceback_file, i_rmsd_file):
         self.traceback_file = traceback_file
         self.i_rmsd_file = i_rmsd_file
 
+    def _traceback_rows(self):
+        """Generator over (line, (it0, it1, water)) of the traceback, the numbers are None for header lines. The
+        rows of a LineageTable are formatted without parsing them back."""
+        if isinstance(self.traceback_file, LineageTable):
+            for line in self.traceback_file.Header().splitlines(True):
+                yield line, None
+            for row in self.traceback_file:
+                yield ROWFORMAT % row, (row[1], row[3], row[5])
+        else:
+            with OpenFile(self.traceback_file) as file:
+                for line in file:
+                    yield line, traceback_numbers(line.split())
+
     def extract_numbers_from_traceback(self):
+        if isinstance(self.traceback_file, LineageTable):
+            return [str(number) for number in self.traceback_file.Column("water") if number > 0]
         numbers = []
-        with open(self.traceback_file) as file:
+        with OpenFile(self.traceback_file) as file:
             for line in file:
-                if line.strip().startswith("complex"):
-                    continue  # Skip the header row
-                columns = line.strip().split()
-                if len(columns) >= 6:
-                   number = columns[5]
-                   if number.isdigit():
-                       numbers.append(number)
-                else:
-                    print(f"Warning: Skipping line due to insufficient columns: {line.strip()}")
+                row = traceback_numbers(line.split())
+                if row is not None and row[2] > 0:  # None for the header lines
+                    numbers.append(str(row[2]))
         return numbers
 
 
   
 
     def update_traceback_with_rmsd(self, output_file, rmsd_values):
-        with open(self.traceback_file) as infile, open(output_file, "w") as outfile:
+        """Append rmsd_values to the traceback rows by position. Use annotate_traceback to join on structure number."""
+        with OpenFile(self.traceback_file) as infile, OpenFile(output_file, "w") as outfile:
             for _ in range(7):
                 outfile.write(next(infile))
             for line, rmsd in zip(infile, rmsd_values):
                 line = line.strip() + f"\t{rmsd}\n"
                 outfile.write(line)
-      
+
+    def compute_metrics(self, rundir, reference, stage="water", workers=None, cache=True):
+        """Compute i-RMSD, l-RMSD and Fnat of the water (or it1) structures of the traceback in rundir against a
+        Reference and return them as MetricTable, ready for annotate_traceback. Results are cached per PDB in
+        metrics.cache in rundir, or in the file cache names when it is a path; cache=False disables the cache."""
+        column = 2 if stage == "water" else 1
+        directory = os.path.join(rundir, "structures", "it1", "water") if stage == "water" else os.path.join(rundir, "structures", "it1")
+        suffix = "w" if stage == "water" else ""
+
+        paths = {}
+        for _, numbers in self._traceback_rows():
+            if numbers is not None and numbers[column] > 0:
+                path = FindFile(os.path.join(directory, f"complex_{numbers[column]}{suffix}.pdb"))
+                if os.path.isfile(path):
+                    paths[numbers[column]] = path
+                else:
+                    print(f"Warning: No structure file for {stage} structure {numbers[column]}")
+
+        results = compute_metrics(reference, list(paths.values()), workers=workers,
+                                  cache_file=cache if isinstance(cache, str) else os.path.join(rundir, "metrics.cache") if cache else None)
+        return MetricTable.from_values(METRICS, {number: results[path] for number, path in paths.items()})
+
+    def annotate_traceback(self, output_file, metric_files=None, key="water"):
+        """Hash join any number of metric files or MetricTables onto the traceback rows by the water or it1
+        structure number and write all metric columns in a single pass. Structures missing from a metric file get
+        NA."""
+        tables = [path if isinstance(path, MetricTable) else MetricTable(path) for path in (metric_files or [self.i_rmsd_file])]
+        column = 2 if key == "water" else 1
+        names = "".join(f"\t{name}" for table in tables for name in table.columns)
+
+        with OpenFile(output_file, "w") as outfile:
+            for line, numbers in self._traceback_rows():
+                if line.rstrip().endswith("hscorew"):
+                    outfile.write(line.rstrip("\n") + names + "\n")
+                    continue
+                if numbers is None:
+                    outfile.write(line)
+                    continue
+                values = [value for table in tables for value in table.get(numbers[column])]
+                outfile.write(line.rstrip("\n") + "\t" + "\t".join(values) + "\n")
+
+    def annotate_stream(self, output_file, metric_file=None, key="water", buffer_size=1 << 20, window=10000):
+        """Fused extract + annotate: read the traceback and a metric file side by side in one streaming pass and
+        write the annotated rows through a buffered writer. Metric rows are matched on structure number; rows
+        that come out of order are held until their traceback row turns up. At most window rows are read ahead
+        for a missing structure, which then gets NA, and at most window rows are held, the oldest are dropped
+        first, so memory stays bounded however far apart the two files are. Returns the water structure numbers
+        as array('l')."""
+        metric_file = metric_file or self.i_rmsd_file
+        column = 2 if key == "water" else 1
+        metrics = iter_metric_file(metric_file)
+        pending = {}
+        columns = []
+        header = None
+        numbers = array("l")
+
+        def fetch(number):
+            # Read ahead in the metric file until number turns up, the file ends or window rows were read
+            nonlocal metrics, columns
+            read = 0
+            while number not in pending and metrics is not None and read < window:
+                metric, values = next(metrics, (False, None))
+                if metric is False:
+                    metrics = None
+                elif metric is None:
+                    columns = columns or values
+                else:
+                    pending[metric] = values
+                    read += 1
+                    if len(pending) > window:
+                        del pending[next(iter(pending))]
+            return pending.pop(number, None)
+
+        with OpenFile(output_file, "w", buffering=buffer_size) as outfile:
+            for line, row in self._traceback_rows():
+                if line.rstrip().endswith("hscorew"):
+                    header = line.rstrip("\n")
+                    continue
+                if row is None:
+                    outfile.write(line)
+                    continue
+
+                values = fetch(row[column]) if row[column] > 0 else None
+                if header is not None:
+                    width = len(values) if values is not None else len(columns) or len(next(iter(pending.values()), []))
+                    columns = column_names(metric_file, columns, width)
+                    outfile.write(header + "".join(f"\t{name}" for name in columns) + "\n")
+                    header = None
+
+                values = (values or []) + ["NA"] * (len(columns) - len(values or []))
+                outfile.write(line.rstrip("\n") + "\t" + "\t".join(values) + "\n")
+                if row[2] > 0:
+                    numbers.append(row[2])
+
+            if header is not None:
+                outfile.write(header + "\n")
+
+        return numbers
+
 
 if __name__ == "__main__":
     traceback_file = "/Users/H/Desktop/Red_Sky/ensemble_477/traceback.list"
@@ -36,8 +481,4 @@ if __name__ == "__main__":
     output_file = "/Users/H/Desktop/Red_Sky/ensemble_477/updated_traceback.list"
 
     data_manipulator = DataManipulator(traceback_file, i_rmsd_file)
-
-    with open(i_rmsd_file) as rmsd_file:
-        rmsd_values = [float(line.strip().split()[1]) for line in rmsd_file if not line.startswith("#")]
-
-    data_manipulator.update_traceback_with_rmsd(output_file,rmsd_values)
+    data_manipulator.annotate_stream(output_file)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+USAGE = """
+==========================================================================================
+
+Aggregate the docking success of the input conformations over many HADDOCK runs.
+
+Every run directory (paths or UNIX glob patterns) is traced in a pool of worker
+processes and the water refined models are grouped on their input complex, the
+'complex' column of traceback.list, and on the conformation of every body
+separately. Per group the number of models and runs, the best and mean HADDOCK
+score and score percentiles are reported. With a per-structure metric file in the
+run directories (default structures/it1/water/i-RMSD.dat or its .gz/.bz2 version,
+read as by addrmsd.py) the success rate is the fraction of the models with a metric
+value at or below each cutoff.
+
+The runs are accumulated in a single pass as they finish, only the scores of the
+groups are kept for the percentiles. The result is written as a tab separated
+table with a 'level' column: pair, body1, body2, ...
+
+Examples:		aggregate.py 'ensemble_*/run1'
+            aggregate.py runs/run* -j 8 -c 1,2,4 -o success.tsv
+            aggregate.py runs/run* -m structures/it1/water/l-RMSD.dat -c 5,10
+
+==========================================================================================
+"""
+
+"""import modules"""
+import os, sys, glob, math
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from optparse import OptionParser
+
+from PDBtraceback import FindFile, LoadLineage
+from addrmsd import MetricTable
+
+METRICFILE = os.path.join('structures', 'it1', 'water', 'i-RMSD.dat')
+
+
+class AggregateError(Exception):
+
+    """Raised when runs can not be aggregated"""
+
+def ReadRun(rundir, metric=METRICFILE, cache=False):
+
+    """Trace rundir and return its water refined models as (input complex names, complex index, hscorew, metric)
+       columns. The metric is the first value of the structure in the metric file of the run, NaN if missing"""
+
+    lineage = LoadLineage(rundir, cache=cache)
+    index = lineage.ComplexIndex()
+    water = lineage.Column('water')
+    score = lineage.Column('hscorew')
+    keep = [n for n in range(len(lineage)) if water[n] > 0 and index[n] >= 0]
+
+    values = array('d', [math.nan]*len(keep))
+    if metric != None and os.path.isfile(FindFile(os.path.join(lineage.rundir, metric))):
+        table = MetricTable(FindFile(os.path.join(lineage.rundir, metric)))
+        for k, n in enumerate(keep):
+            try:
+                values[k] = float(table.values[water[n]][0])
+            except (KeyError, IndexError, ValueError):
+                pass
+
+    complexes = dict((index[n], lineage.complexes[index[n]]) for n in keep)
+
+    return complexes, array('i', [index[n] for n in keep]), array('d', [score[n] for n in keep]), values
+
+def Percentile(values, percentile):
+
+    """Percentile of sorted values with linear interpolation between the closest ranks"""
+
+    if len(values) == 0:
+        return math.nan
+    position = (len(values)-1)*percentile/100.0
+    low = int(math.floor(position))
+    high = min(low+1, len(values)-1)
+
+    return values[low] + (values[high]-values[low])*(position-low)
+
+class GroupStats:
+
+    """Single pass accumulator of the models of one group. Keeps counts, score sum and best score, the number
+       of models at or below every metric cutoff and the scores themselves for the percentiles"""
+
+    def __init__(self, cutoffs=()):
+
+        self.cutoffs = cutoffs
+        self.count = 0
+        self.best = math.inf
+        self.total = 0.0
+        self.scores = array('d')
+        self.runs = set()
+        self.nrmetric = 0
+        self.success = [0]*len(cutoffs)
+
+    def Add(self, run, score, metric):
+
+        self.count = self.count+1
+        self.total = self.total+score
+        if score < self.best:
+            self.best = score
+        self.scores.append(score)
+        self.runs.add(run)
+        if metric == metric:
+            self.nrmetric = self.nrmetric+1
+            for n, cutoff in enumerate(self.cutoffs):
+                if metric <= cutoff:
+                    self.success[n] = self.success[n]+1
+
+    def Merge(self, other):
+
+        """Add the models accumulated in other to this group"""
+
+        self.count = self.count+other.count
+        self.total = self.total+other.total
+        self.best = min(self.best, other.best)
+        self.scores.extend(other.scores)
+        self.runs.update(other.runs)
+        self.nrmetric = self.nrmetric+other.nrmetric
+        self.success = [a+b for a, b in zip(self.success, other.success)]
+
+    def Row(self, percentiles=()):
+
+        """Values of the group in the column order of Header"""
+
+        scores = sorted(self.scores)
+        row = [self.count, len(self.runs), self.best, self.total/max(self.count, 1)]
+        row.extend(Percentile(scores, percentile) for percentile in percentiles)
+        row.append(self.nrmetric)
+        row.extend(success/float(self.nrmetric) if self.nrmetric else math.nan for success in self.success)
+
+        return row
+
+def Header(cutoffs=(), percentiles=()):
+
+    """Column names of the aggregate table"""
+
+    names = ['level', 'group', 'models', 'runs', 'best', 'mean']
+    names.extend('p%g' % percentile for percentile in percentiles)
+    names.append('metric')
+    names.extend('success<=%g' % cutoff for cutoff in cutoffs)
+
+    return names
+
+def AggregateRuns(rundirs, metric=METRICFILE, cutoffs=(), workers=None, cache=False):
+
+    """Trace all runs over a pool of worker processes and accumulate their water refined models per input pair
+       as the runs finish. A failing run is reported and does not stop the others. Returns ({pair: GroupStats},
+       {run: error message})"""
+
+    runs = []
+    for pattern in rundirs:
+        runs.extend(sorted(glob.glob(pattern)) or [pattern])
+    if len(runs) == 0:
+        raise AggregateError("No run directories to aggregate")
+
+    print("--> Aggregating %i runs" % len(runs))
+
+    pairs = {}
+    failed = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for run in runs:
+            futures[pool.submit(ReadRun, run, metric, cache)] = run
+        for future in as_completed(futures):
+            run = futures[future]
+            try:
+                complexes, index, score, values = future.result()
+            except Exception as error:
+                failed[run] = str(error)
+                print("    * ERROR: Traceback of run %s failed: %s" % (run, error))
+                continue
+
+            groups = {}
+            for n in range(len(index)):
+                group = groups.get(index[n])
+                if group == None:
+                    group = groups[index[n]] = pairs.setdefault(complexes[index[n]], GroupStats(cutoffs))
+                group.Add(run, score[n], values[n])
+
+    return pairs, failed
+
+def GroupBodies(pairs, cutoffs=()):
+
+    """Merge the input pair groups into one {conformation: GroupStats} per body"""
+
+    bodies = []
+    for pair, stats in pairs.items():
+        for body, conformation in enumerate(pair.split('/')):
+            if len(bodies) <= body:
+                bodies.append({})
+            bodies[body].setdefault(conformation, GroupStats(cutoffs)).Merge(stats)
+
+    return bodies
+
+def WriteAggregate(path, pairs, bodies, cutoffs=(), percentiles=()):
+
+    """Write the pair and body groups as tab separated table, every level sorted on best score"""
+
+    with open(path, 'w') as outfile:
+        outfile.write('\t'.join(Header(cutoffs, percentiles)) + '\n')
+        levels = [('pair', pairs)] + [('body%i' % (n+1), groups) for n, groups in enumerate(bodies)]
+        for level, groups in levels:
+            for group, stats in sorted(groups.items(), key=lambda item: (item[1].best, item[0])):
+                fields = [level, group] + ['%.4f' % value if isinstance(value, float) else str(value) for value in stats.Row(percentiles)]
+                outfile.write('\t'.join(fields) + '\n')
+
+if __name__ == '__main__':
+
+    """Running from the command line"""
+
+    parser = OptionParser("usage: %prog rundirs" + USAGE)
+    parser.add_option( "-o", "--output", dest="output", type="string", default="aggregate.tsv", help="Aggregate table file, default=aggregate.tsv")
+    parser.add_option( "-j", "--workers", dest="workers", type="int", default=None, help="Number of worker processes, default=number of CPUs")
+    parser.add_option( "-m", "--metric", dest="metric", type="string", default=METRICFILE, help="Metric file relative to the run directory, default=%s" % METRICFILE)
+    parser.add_option( "-c", "--cutoffs", dest="cutoffs", type="string", default="1,2,4", help="Comma separated metric cutoffs of the success rates, default=1,2,4")
+    parser.add_option( "-p", "--percentiles", dest="percentiles", type="string", default="10,50,90", help="Comma separated score percentiles, default=10,50,90")
+    parser.add_option( "--cache", action="store_true", dest="cache", default=False, help="Use and update the traceback.cache of the runs")
+    (options, args) = parser.parse_args()
+
+    if len(args) == 0:
+        print("    * ERROR: Supply the run directories to aggregate")
+        sys.exit(0)
+
+    cutoffs = [float(cutoff) for cutoff in options.cutoffs.split(',') if cutoff]
+    percentiles = [float(percentile) for percentile in options.percentiles.split(',') if percentile]
+
+    try:
+        pairs, failed = AggregateRuns(args, metric=options.metric, cutoffs=cutoffs, workers=options.workers, cache=options.cache)
+    except AggregateError as error:
+        print("    * ERROR: %s" % error)
+        sys.exit(0)
+
+    WriteAggregate(options.output, pairs, GroupBodies(pairs, cutoffs), cutoffs, percentiles)
+    print("    * %i input pairs of %i models written to %s" % (len(pairs), sum(stats.count for stats in pairs.values()), options.output))
+    print("--> %i runs failed" % len(failed) if failed else "--> All runs aggregated")
+    sys.exit(0)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+USAGE = """
+==========================================================================================
+
+Benchmarks for PDBtraceback.py and addrmsd.py on synthetic HADDOCK data.
+
+filelist:	Parse synthetic file.list files of increasing size with the original
+            per-line code, the streaming IterFileList generator and the bulk
+            memory mapped ParseFileList parser.
+run:		Generate synthetic run directories (begin/file_1.list, file_2.list,
+            structures/it0, it1 and it1/water file.list and i-RMSD.dat) for
+            every combination of number of it0 models (-s) and ensemble members
+            per body (-m) and time every traceback stage, the report of a
+            query on all water structures and the i-RMSD annotation of
+            addrmsd.py. The peak memory of every stage is measured in a
+            separate pass with tracemalloc.
+
+With -o all results are written as JSON together with the commit and Python version,
+with -c the timings are compared to such a JSON file of an earlier commit.
+
+Examples:		benchmark.py filelist
+            benchmark.py filelist -s 10000,100000 -r 5
+            benchmark.py run -s 1000,100000,1000000 -m 1,10,50 -o results.json
+            benchmark.py run -s 1000,100000 -c results.json
+
+==========================================================================================
+"""
+
+"""import modules"""
+import os, sys, json, time, random, shutil, platform, tempfile, subprocess, tracemalloc
+from contextlib import redirect_stdout
+from optparse import OptionParser
+
+from PDBtraceback import ParseFileList, StructureTraceback
+from addrmsd import DataManipulator
+
+STAGES = ('GetStartStruc', 'GetWatStructures', 'GetIt1Structures', 'GetIt0Structures', 'ResolveLineage', 'WriteFile',
+          'ReportQuery', 'extract_numbers_from_traceback', 'update_traceback_with_rmsd', 'annotate_stream')
+
+
+def LegacyParse(path):
+
+    """The file.list parsing as done by StructureTraceback before the shared parser: readlines, two splits per
+       line and the float fallback of _FormatLine for the 'w' suffix"""
+
+    def FormatLine(line):
+        base = os.path.splitext(line.strip('""'))
+        base2 = (base[0].split(':'))[1]
+        base3 = base2.split('_')[-1]
+        try:
+            return float(base3)
+        except:
+            return float((base3.split('w'))[0])
+
+    stage = []
+    with open(path, 'r') as filelist:
+        lines = filelist.readlines()
+        for line in lines:
+            if line == '\n':
+                pass
+            else:
+                tmp = []
+                tmp.append(FormatLine(line.split()[0]))
+                tmp.append(float(line.split()[2]))
+                stage.append(tmp)
+
+    return stage
+
+def WriteFileList(path, nrlines, water=False, seed=0):
+
+    """Write a synthetic HADDOCK file.list with nrlines structures sorted on HADDOCK score"""
+
+    rnd = random.Random(seed)
+    scores = sorted((round(rnd.uniform(-250, 250), 4), n+1) for n in range(nrlines))
+    suffix = 'w' if water else ''
+
+    with open(path, 'w') as filelist:
+        for score, number in scores:
+            filelist.write('"PREVIT:complex_%i%s.pdb"  { %.4f }\n' % (number, suffix, score))
+
+def WriteRun(rundir, nrmodels, members=(1, 1), seed=0):
+
+    """Write a synthetic HADDOCK run directory with nrmodels it0 models, a fifth of them refined in it1 and
+       water, and members[0] and members[1] ensemble members for the two bodies in the begin directory. The
+       water structures get an i-RMSD.dat. Returns the number of (it0, it1, water) structures"""
+
+    rnd = random.Random(seed)
+    nrit1 = max(1, nrmodels//5)
+
+    for directory in ('begin', os.path.join('structures', 'it0'), os.path.join('structures', 'it1', 'water')):
+        if not os.path.isdir(os.path.join(rundir, directory)):
+            os.makedirs(os.path.join(rundir, directory))
+
+    for body, nrmembers in enumerate(members):
+        with open(os.path.join(rundir, 'begin', 'file_%i.list' % (body+1)), 'w') as filelist:
+            for member in range(nrmembers):
+                filelist.write('"PREVIT:prot%i_%i.pdb"\n' % (body+1, member+1))
+
+    WriteFileList(os.path.join(rundir, 'structures', 'it0', 'file.list'), nrmodels, seed=rnd.random())
+    WriteFileList(os.path.join(rundir, 'structures', 'it1', 'file.list'), nrit1, seed=rnd.random())
+    WriteFileList(os.path.join(rundir, 'structures', 'it1', 'water', 'file.list'), nrit1, water=True, seed=rnd.random())
+
+    with open(os.path.join(rundir, 'i-RMSD.dat'), 'w') as rmsd:
+        rmsd.write('#struc i-RMSD\n')
+        for number in range(nrit1):
+            rmsd.write('complex_%iw.pdb %.3f\n' % (number+1, rnd.uniform(0.5, 20)))
+
+    return nrmodels, nrit1, nrit1
+
+def RunStages(rundir, memory=False):
+
+    """Run every stage of a traceback and i-RMSD annotation of rundir in turn. Returns {stage: seconds}, or
+       {stage: peak bytes} with memory"""
+
+    results = {}
+    traceback = StructureTraceback()
+    traceback.rundir = rundir
+    manipulator = DataManipulator(os.path.join(rundir, 'traceback.list'), os.path.join(rundir, 'i-RMSD.dat'))
+    output = os.path.join(rundir, 'annotated.list')
+    numbers = []
+
+    stages = [('GetStartStruc', traceback.GetStartStruc),
+              ('GetWatStructures', traceback.GetWatStructures),
+              ('GetIt1Structures', traceback.GetIt1Structures),
+              ('GetIt0Structures', traceback.GetIt0Structures),
+              ('ResolveLineage', traceback.ResolveLineage),
+              ('WriteFile', traceback.WriteFile),
+              ('ReportQuery', lambda: traceback.ReportQuery(verbose=False)),
+              ('extract_numbers_from_traceback', lambda: numbers.extend(manipulator.extract_numbers_from_traceback())),
+              # the positional legacy path appends whatever values it is given, the extracted numbers will do
+              ('update_traceback_with_rmsd', lambda: manipulator.update_traceback_with_rmsd(output, numbers)),
+              ('annotate_stream', lambda: manipulator.annotate_stream(output))]
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for stage, function in stages:
+            if stage == 'ReportQuery':
+                # WriteFile output is replaced by the report, annotate the traceback.list itself
+                shutil.copy(os.path.join(rundir, 'traceback.list'), os.path.join(rundir, 'traceback.keep'))
+                traceback.query = [('water', number) for number in traceback.lineage.Column('water') if number > 0]
+            if memory == True:
+                tracemalloc.start()
+                function()
+                results[stage] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                start = time.perf_counter()
+                function()
+                results[stage] = time.perf_counter() - start
+            if stage == 'ReportQuery':
+                os.replace(os.path.join(rundir, 'traceback.keep'), os.path.join(rundir, 'traceback.list'))
+
+    return results
+
+def BenchRun(sizes, members, repeat=3):
+
+    """Time and memory profile the traceback stages on synthetic runs of every combination of sizes (number of
+       it0 models) and members (ensemble members per body). Returns a list of result dicts"""
+
+    tmpdir = tempfile.mkdtemp(prefix='traceback_bench_')
+    results = []
+    try:
+        print('%10s%9s%32s%12s%12s' % ('models', 'members', 'stage', 'time', 'peak MB'))
+        for size in sizes:
+            for nrmembers in members:
+                rundir = os.path.join(tmpdir, 'run_%i_%i' % (size, nrmembers))
+                WriteRun(rundir, size, members=(nrmembers, nrmembers))
+
+                timings = [RunStages(rundir) for n in range(repeat)]
+                peaks = RunStages(rundir, memory=True)
+                for stage in STAGES:
+                    result = {'benchmark': 'run', 'models': size, 'members': nrmembers, 'stage': stage,
+                              'time': min(timing[stage] for timing in timings), 'peak': peaks[stage]}
+                    results.append(result)
+                    print('%10i%9i%32s%11.3fs%12.1f' % (size, nrmembers, stage, result['time'], result['peak']/1048576.0))
+                shutil.rmtree(rundir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+def Environment():
+
+    """The commit, Python version and platform the benchmarks ran on"""
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def ResultKey(result):
+
+    """The parameters identifying a benchmark result, everything but the measurements"""
+
+    return tuple(sorted((key, value) for key, value in result.items() if isinstance(value, (str, int)) and key != 'peak'))
+
+def CompareResults(reference, results):
+
+    """Print the timings of results relative to the matching results of an earlier JSON output"""
+
+    print('--> Compared to commit %s' % reference.get('environment', {}).get('commit'))
+    previous = dict((ResultKey(result), result) for result in reference.get('results', []))
+    for result in results:
+        old = previous.get(ResultKey(result))
+        if old == None:
+            continue
+        for measure in ('time', 'legacy', 'generator', 'bulk'):
+            if measure in result and old.get(measure):
+                label = ' '.join('%s=%s' % item for item in ResultKey(result) if item[0] != 'benchmark')
+                print('    %-70s%8s%9.3fs ->%9.3fs%8.2fx' % (label, measure, old[measure], result[measure], old[measure]/max(result[measure], 1e-9)))
+
+def Timeit(function, repeat=3):
+
+    """Best wall time of repeat calls to function"""
+
+    best = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def BenchFileList(sizes, repeat=3):
+
+    """Time the file.list parsers on synthetic lists of the given sizes. Returns a list of result dicts"""
+
+    parsers = [('legacy', LegacyParse),
+               ('generator', lambda path: ParseFileList(path, bulk=False)),
+               ('bulk', lambda path: ParseFileList(path, bulk=True))]
+
+    tmpdir = tempfile.mkdtemp(prefix='traceback_bench_')
+    results = []
+    try:
+        print('%10s%12s%12s%12s%10s' % ('lines', 'legacy', 'generator', 'bulk', 'speedup'))
+        for size in sizes:
+            path = os.path.join(tmpdir, 'file.list')
+            WriteFileList(path, size)
+            timing = {'benchmark': 'filelist', 'lines': size}
+            for name, parser in parsers:
+                timing[name] = Timeit(lambda: parser(path), repeat=repeat)
+            results.append(timing)
+            print('%10i%11.3fs%11.3fs%11.3fs%9.1fx' % (size, timing['legacy'], timing['generator'], timing['bulk'],
+                  timing['legacy']/timing['bulk']))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+if __name__ == '__main__':
+
+    """Running from the command line"""
+
+    parser = OptionParser("usage: %prog [filelist] [run]" + USAGE)
+    parser.add_option( "-s", "--sizes", dest="sizes", type="string", default="10000,100000,1000000", help="Comma separated number of lines of the synthetic lists or it0 models of the synthetic runs, default=10000,100000,1000000")
+    parser.add_option( "-m", "--members", dest="members", type="string", default="1,10,50", help="Comma separated number of ensemble members per body of the synthetic runs, default=1,10,50")
+    parser.add_option( "-r", "--repeat", dest="repeat", type="int", default=3, help="Number of repeats, the best time is reported, default=3")
+    parser.add_option( "-o", "--output", dest="output", type="string", default=None, help="Write the results as JSON to this file")
+    parser.add_option( "-c", "--compare", dest="compare", type="string", default=None, help="Compare the timings to the JSON results of an earlier run")
+    (options, args) = parser.parse_args()
+
+    benchmarks = args or ['filelist']
+    sizes = [int(size) for size in options.sizes.split(',')]
+    members = [int(member) for member in options.members.split(',')]
+
+    results = []
+    if 'filelist' in benchmarks:
+        results.extend(BenchFileList(sizes, repeat=options.repeat))
+    if 'run' in benchmarks:
+        results.extend(BenchRun(sizes, members, repeat=options.repeat))
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump({'environment': Environment(), 'results': results}, output, indent=1)
+        print("--> Results written to %s" % options.output)
+
+    if options.compare:
+        with open(options.compare, 'r') as reference:
+            CompareResults(json.load(reference), results)
+
+    sys.exit(0)
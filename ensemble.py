@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+
+USAGE = """
+==========================================================================================
+
+Build multi-model ensemble PDB files from the conformations saved from the PyMOL
+mutagenesis wizard, without starting PyMOL. Replaces the load loop of ensemble.pml.
+
+Conformations are discovered by glob in every directory given (default: the current
+directory) and grouped on the part after the last '_', so conformation1_477.pdb,
+conformation2_477.pdb, ... end up in one ensemble. A directory holding a single group
+gets an ensemble.pdb, a directory holding several gets one ensemble_<group>.pdb per
+group. All conformations of an ensemble must have identical atom records (atom name,
+residue name, chain, residue number) in the same order.
+
+The coordinate records of every conformation are copied between MODEL/ENDMDL records
+with os.sendfile where available, so atoms are never parsed or rebuilt. Ensembles
+are built in parallel over a process pool. Conformations compressed with gzip or bzip2
+(conformation1_477.pdb.gz) are decompressed while they are copied.
+
+With an RMSD cutoff (-r, requires NumPy) near-identical rotamers are clustered first and
+only the cluster representatives go into the ensemble. The RMSD is computed without
+superposition over the atoms of the residues given with --residues, or by default over
+all atoms that move between the conformations (the mutated side chain). The members of
+every ensemble model are written to <ensemble>_clusters.list.
+
+With -s an existing ensemble is not built but indexed: the byte offsets of its MODEL/ENDMDL
+blocks are kept in a sidecar <ensemble>.idx, rebuilt whenever the ensemble changes, and
+the models given with -m (model numbers or input structure names such as those in the
+complex column of traceback.list) are written, in that order, as a sub-ensemble to -o.
+
+Examples:		ensemble.py
+            ensemble.py mutant_477 mutant_478 -j 4
+            ensemble.py -p 'conformation*_11.pdb' -o ensemble.pdb
+            ensemble.py mutant_477 -r 0.5
+            ensemble.py -s ensemble.pdb -m 12,3,7 -o top.pdb
+
+==========================================================================================
+"""
+
+"""import modules"""
+import os, re, sys, glob, mmap, struct, hashlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from optparse import OptionParser
+
+from PDBtraceback import COMPRESSORS, Compressed, OpenFile, StructureNumber
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CONFORMATION = re.compile(r'(\d+)_([^_]+)\.pdb(?:\.gz|\.bz2)?$')
+ATOMRECORDS = (b'ATOM  ', b'HETATM')
+MODELRECORD = re.compile(rb'^MODEL[ \t]*(\d*)[^\n]*\n', re.M)
+INDEXMAGIC = b'EIX1'
+INDEXHEADER = struct.Struct('<4sQqI')
+
+
+class EnsembleError(Exception):
+
+    """Raised when an ensemble can not be built"""
+
+def FindConformations(directory, pattern='conformation*_*.pdb'):
+
+    """Conformations matching pattern, or pattern with a .gz or .bz2 extension, in directory grouped on the part
+       after the last '_'. An uncompressed conformation is preferred over a compressed copy. Returns
+       {group: [paths sorted on conformation number]}"""
+
+    groups = {}
+    for extension in [''] + sorted(COMPRESSORS):
+        for path in glob.glob(os.path.join(directory, pattern + extension)):
+            match = CONFORMATION.search(os.path.basename(path))
+            if match:
+                groups.setdefault(match.group(2), {}).setdefault(int(match.group(1)), path)
+
+    return dict((group, [paths[number] for number in sorted(paths)]) for group, paths in groups.items())
+
+def ScanConformation(path):
+
+    """Single pass over a PDB file returning (atom record digest, start, end). The digest covers the atom
+       identification columns of all ATOM/HETATM records, start and end are the byte offsets of the block of
+       coordinate records (ATOM/HETATM/TER) that is copied into the ensemble"""
+
+    digest = hashlib.sha1()
+    start = end = None
+    offset = 0
+
+    with OpenFile(path, 'rb') as pdb:
+        for line in pdb:
+            record = line[0:6]
+            if record in ATOMRECORDS:
+                digest.update(line[12:27])
+                if start == None:
+                    start = offset
+                end = offset+len(line)
+            elif record.startswith(b'TER') and start != None:
+                end = offset+len(line)
+            offset = offset+len(line)
+
+    if start == None:
+        raise EnsembleError("No atom records in %s" % path)
+
+    return digest.hexdigest(), start, end
+
+def ReadCoordinates(path, residues=None):
+
+    """Coordinates of the ATOM/HETATM records of a PDB file as (atoms, 3) array, restricted to the residue
+       numbers in residues if given"""
+
+    coordinates = []
+    with OpenFile(path, 'rb') as pdb:
+        for line in pdb:
+            if line[0:6] in ATOMRECORDS and (residues == None or int(line[22:26]) in residues):
+                coordinates.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+
+    return numpy.array(coordinates, dtype=float).reshape(-1, 3)
+
+def PairwiseRMSD(coordinates):
+
+    """All pairwise RMSDs, without superposition, of a (conformations, atoms, 3) coordinate array in one batched
+       matrix product"""
+
+    flat = coordinates.reshape(len(coordinates), -1)
+    squared = (flat*flat).sum(axis=1)
+    distances = squared[:, None] + squared[None, :] - 2.0*numpy.dot(flat, flat.T)
+
+    return numpy.sqrt(numpy.maximum(distances, 0.0)/max(coordinates.shape[1], 1))
+
+def ClusterConformations(conformations, cutoff, residues=None):
+
+    """Greedy clustering of conformations at an RMSD cutoff: the conformation with most unclustered neighbours
+       within cutoff becomes a representative and takes those neighbours as members, until all conformations are
+       clustered. Returns [(representative, [members])] in conformation order of the representatives"""
+
+    if numpy == None:
+        raise EnsembleError("Clustering conformations requires NumPy")
+
+    coordinates = [ReadCoordinates(path, residues=residues) for path in conformations]
+    if len(set(coordinate.shape for coordinate in coordinates)) != 1:
+        raise EnsembleError("Conformations do not have the same number of atoms to cluster on")
+    coordinates = numpy.array(coordinates)
+
+    if residues == None:
+        moving = (coordinates.max(axis=0)-coordinates.min(axis=0)).max(axis=1) > 1e-3
+        coordinates = coordinates[:, moving]
+
+    neighbours = PairwiseRMSD(coordinates) <= cutoff
+    unclustered = numpy.ones(len(conformations), dtype=bool)
+    clusters = []
+    while unclustered.any():
+        counts = (neighbours & unclustered).sum(axis=1)
+        counts[~unclustered] = -1
+        center = int(counts.argmax())
+        members = numpy.flatnonzero(neighbours[center] & unclustered)
+        unclustered[members] = False
+        clusters.append((center, [int(member) for member in members]))
+
+    clusters.sort()
+    return [(conformations[center], [conformations[member] for member in members]) for center, members in clusters]
+
+def WriteClusters(clusters, path):
+
+    """Write the model number, representative and members of every cluster so traceback results on ensemble
+       models can be expanded back to the conformations"""
+
+    with open(path, 'w') as mapping:
+        mapping.write('#model representative members\n')
+        for model, (representative, members) in enumerate(clusters):
+            mapping.write('%i %s %s\n' % (model+1, os.path.basename(representative), ','.join(os.path.basename(member) for member in members)))
+
+def CopyRange(source, target, start, end, zerocopy=True):
+
+    """Copy bytes start to end of the source file to the target file descriptor, zero-copy with os.sendfile
+       when the platform supports it. Without zerocopy, as for compressed sources, the bytes are read"""
+
+    count = end-start
+    try:
+        if zerocopy == False:
+            raise AttributeError
+        while count > 0:
+            sent = os.sendfile(target, source.fileno(), start, count)
+            if sent == 0:
+                break
+            start = start+sent
+            count = count-sent
+    except (AttributeError, OSError):
+        source.seek(start)
+        while count > 0:
+            block = source.read(min(count, 1 << 20))
+            if not block:
+                break
+            os.write(target, block)
+            count = count-len(block)
+
+def BuildEnsemble(conformations, outfile, check=True, cutoff=None, residues=None):
+
+    """Stream the coordinate records of the conformations into outfile as consecutive MODEL/ENDMDL blocks.
+       With check all conformations must have the same atom records as the first one. With an RMSD cutoff only
+       the cluster representatives are included (see ClusterConformations). Returns outfile"""
+
+    if len(conformations) == 0:
+        raise EnsembleError("No conformations to build %s from" % outfile)
+
+    if cutoff != None:
+        clusters = ClusterConformations(conformations, cutoff, residues=residues)
+        WriteClusters(clusters, os.path.splitext(outfile)[0] + '_clusters.list')
+        conformations = [representative for representative, members in clusters]
+
+    scans = [ScanConformation(path) for path in conformations]
+    if check == True:
+        for path, scan in zip(conformations, scans):
+            if scan[0] != scans[0][0]:
+                raise EnsembleError("Atom records of %s differ from %s" % (path, conformations[0]))
+
+    target = os.open(outfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for model, (path, scan) in enumerate(zip(conformations, scans)):
+            os.write(target, b'MODEL     %4i\n' % (model+1))
+            with OpenFile(path, 'rb') as source:
+                CopyRange(source, target, scan[1], scan[2], zerocopy=not Compressed(path))
+                source.seek(scan[2]-1)
+                if source.read(1) != b'\n':
+                    os.write(target, b'\n')
+            os.write(target, b'ENDMDL\n')
+        os.write(target, b'END\n')
+    finally:
+        os.close(target)
+
+    return outfile
+
+class EnsembleIndex:
+
+    """Random access to the models of a multi-model ensemble PDB. The ensemble is memory mapped and the byte
+       offsets of the coordinate block of every MODEL/ENDMDL record pair are kept in a sidecar index
+       (<ensemble>.idx) that is rebuilt when the size or mtime of the ensemble changes. Models are zero-copy
+       slices of the mapped file, release them before Close"""
+
+    def __init__(self, path, sidecar=True):
+
+        if Compressed(path):
+            raise EnsembleError("Can not index compressed ensemble %s, decompress it first" % path)
+
+        self.path = path
+        self.indexfile = path + '.idx' if sidecar else None
+        self.file = open(path, 'rb')
+        stat = os.fstat(self.file.fileno())
+        if stat.st_size == 0:
+            self.file.close()
+            raise EnsembleError("Ensemble %s is empty" % path)
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.buffer)
+
+        self.offsets = self._Load(stat)
+        if self.offsets == None:
+            self.offsets = self._Build(stat)
+        self.models = dict((self.offsets[n], n) for n in range(0, len(self.offsets), 3))
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.Close()
+
+    def __len__(self):
+
+        return len(self.models)
+
+    def _Load(self, stat):
+
+        """Offsets from the sidecar index, None if there is none or it does not match the ensemble"""
+
+        if self.indexfile == None or not os.path.isfile(self.indexfile):
+            return None
+        with open(self.indexfile, 'rb') as index:
+            blob = index.read()
+        if len(blob) < INDEXHEADER.size:
+            return None
+        magic, size, mtime, count = INDEXHEADER.unpack_from(blob)
+        if magic != INDEXMAGIC or size != stat.st_size or mtime != stat.st_mtime_ns or len(blob) != INDEXHEADER.size + count*24:
+            return None
+
+        offsets = array('q')
+        offsets.frombytes(blob[INDEXHEADER.size:])
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return offsets
+
+    def _Build(self, stat):
+
+        """Scan the mapped ensemble once for (model number, start, end) of every coordinate block and write the
+           sidecar index when possible"""
+
+        offsets = array('q')
+        for match in MODELRECORD.finditer(self.buffer):
+            end = self.buffer.find(b'ENDMDL', match.end())
+            if end < 0:
+                raise EnsembleError("MODEL without ENDMDL record at byte %i of %s" % (match.start(), self.path))
+            number = int(match.group(1)) if match.group(1) else len(offsets)//3+1
+            offsets.extend((number, match.end(), end))
+        if len(offsets) == 0:
+            raise EnsembleError("No MODEL records in %s" % self.path)
+
+        if self.indexfile != None:
+            stored = array('q', offsets)
+            if sys.byteorder == 'big':
+                stored.byteswap()
+            try:
+                with open(self.indexfile + '.tmp', 'wb') as index:
+                    index.write(INDEXHEADER.pack(INDEXMAGIC, stat.st_size, stat.st_mtime_ns, len(offsets)//3) + stored.tobytes())
+                os.replace(self.indexfile + '.tmp', self.indexfile)
+            except OSError as error:
+                print("    * WARNING: Could not write index %s: %s" % (self.indexfile, error))
+
+        return offsets
+
+    def Numbers(self):
+
+        """Model numbers in file order"""
+
+        return [self.offsets[n] for n in range(0, len(self.offsets), 3)]
+
+    def Model(self, number):
+
+        """The coordinate records of a model as memoryview of the mapped ensemble"""
+
+        if not number in self.models:
+            raise EnsembleError("No model %i in %s" % (number, self.path))
+        n = self.models[number]
+
+        return self.view[self.offsets[n+1]:self.offsets[n+2]]
+
+    def Extract(self, number, outfile):
+
+        """Write a single model as PDB file. Returns outfile"""
+
+        with open(outfile, 'wb') as pdb:
+            pdb.write(self.Model(number))
+            pdb.write(b'END\n')
+
+        return outfile
+
+    def Write(self, outfile, numbers):
+
+        """Write the models numbers, in that order, as a new ensemble renumbered from 1. Returns outfile"""
+
+        for number in numbers:
+            if not number in self.models:
+                raise EnsembleError("No model %i in %s" % (number, self.path))
+
+        with open(outfile, 'wb') as pdb:
+            for model, number in enumerate(numbers):
+                pdb.write(b'MODEL     %4i\n' % (model+1))
+                pdb.write(self.Model(number))
+                pdb.write(b'ENDMDL\n')
+            pdb.write(b'END\n')
+
+        return outfile
+
+    def Close(self):
+
+        try:
+            self.view.release()
+            self.buffer.close()
+        except BufferError:
+            raise EnsembleError("Models of %s are still in use, release them before closing the index" % self.path)
+        self.file.close()
+
+def BuildEnsembles(directories, pattern='conformation*_*.pdb', output='ensemble.pdb', workers=None, check=True, cutoff=None,
+                   residues=None):
+
+    """Build the ensembles of all conformation groups found in directories over a process pool. A failing
+       ensemble is reported and does not stop the others. Returns {ensemble: error message} for the failures"""
+
+    jobs = {}
+    for directory in directories:
+        groups = FindConformations(directory, pattern=pattern)
+        if len(groups) == 0:
+            print("    * WARNING: No conformations matching %s in %s" % (pattern, directory))
+        for group, conformations in groups.items():
+            if len(groups) == 1:
+                outfile = os.path.join(directory, output)
+            else:
+                base, extension = os.path.splitext(output)
+                outfile = os.path.join(directory, '%s_%s%s' % (base, group, extension))
+            jobs[outfile] = conformations
+
+    failed = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for outfile, conformations in jobs.items():
+            futures[pool.submit(BuildEnsemble, conformations, outfile, check, cutoff, residues)] = outfile
+        for future in as_completed(futures):
+            outfile = futures[future]
+            try:
+                future.result()
+                if cutoff != None:
+                    print("    * Ensemble of %i conformations clustered at %.2f A written to %s" % (len(jobs[outfile]), cutoff, outfile))
+                else:
+                    print("    * Ensemble of %i conformations written to %s" % (len(jobs[outfile]), outfile))
+            except (EnsembleError, IOError) as error:
+                failed[outfile] = str(error)
+                print("    * ERROR: Building %s failed: %s" % (outfile, error))
+
+    return failed
+
+if __name__ == '__main__':
+
+    """Running from the command line"""
+
+    parser = OptionParser("usage: %prog [directories]" + USAGE)
+    parser.add_option( "-p", "--pattern", dest="pattern", type="string", default="conformation*_*.pdb", help="Glob pattern of the conformation files, default=conformation*_*.pdb")
+    parser.add_option( "-o", "--output", dest="output", type="string", default="ensemble.pdb", help="Name of the ensemble file, default=ensemble.pdb")
+    parser.add_option( "-j", "--workers", dest="workers", type="int", default=None, help="Number of worker processes, default=number of CPUs")
+    parser.add_option( "-n", "--no-check", action="store_false", dest="check", default=True, help="Do not check that all conformations have the same atom records")
+    parser.add_option( "-r", "--rmsd-cutoff", dest="cutoff", type="float", default=None, help="Cluster the conformations at this RMSD (A) and only include the representatives, requires NumPy")
+    parser.add_option( "--residues", dest="residues", type="string", default=None, help="Comma separated residue numbers to cluster on, default=all atoms that move between conformations")
+    parser.add_option( "-s", "--subset", dest="subset", type="string", default=None, help="Write a sub-ensemble of this ensemble PDB instead of building ensembles")
+    parser.add_option( "-m", "--models", dest="models", type="string", default=None, help="With -s, comma separated model numbers or input structure names (prot1_3.pdb) in output order")
+    (options, args) = parser.parse_args()
+
+    if options.subset:
+        try:
+            numbers = [int(model) if model.isdigit() else StructureNumber(model) for model in (options.models or '').split(',') if model]
+            if os.path.abspath(options.output) == os.path.abspath(options.subset):
+                raise EnsembleError("The sub-ensemble can not overwrite %s, use -o" % options.subset)
+            with EnsembleIndex(options.subset) as index:
+                numbers = numbers or index.Numbers()
+                index.Write(options.output, numbers)
+            print("--> Sub-ensemble of %i models written to %s" % (len(numbers), options.output))
+        except (EnsembleError, ValueError, IOError) as error:
+            print("    * ERROR: %s" % error)
+        sys.exit(0)
+
+    residues = None
+    if options.residues:
+        residues = set(int(residue) for residue in options.residues.split(','))
+
+    print("--> Building ensembles")
+    failed = BuildEnsembles(args or [os.getcwd()], pattern=options.pattern, output=options.output, workers=options.workers, check=options.check,
+                            cutoff=options.cutoff, residues=residues)
+    print("--> %i ensembles failed" % len(failed) if failed else "--> All ensembles built")
+    sys.exit(0)
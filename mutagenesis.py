@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+USAGE = """
+==========================================================================================
+
+Headless batch version of mutagenesis.pml. Every job is a (chain, residue, target amino
+acid) triple given as CHAIN:RESI:AA on the command line or one 'CHAIN RESI AA' per
+line in a job file. For every job all rotamers offered by the PyMOL mutagenesis wizard
+are applied and saved as conformation<k>_<resi>.pdb in the directory
+<outdir>/mutant_<chain><resi><aa>, optionally followed by the ensemble.pdb of these
+conformations (see ensemble.py).
+
+Jobs run in a pool of worker processes, each with its own pymol2 instance that loads
+the input structure once. With --fake a stand-in for the PyMOL cmd module is used,
+which allows testing the driver without PyMOL installed.
+
+Examples:		mutagenesis.py protein.pdb B:477:ASN B:478:LYS
+            mutagenesis.py protein.pdb -f jobs.txt -j 8 --ensemble -o scan
+            mutagenesis.py --selftest
+
+==========================================================================================
+"""
+
+"""import modules"""
+import os, sys, shutil, tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from importlib.util import find_spec
+from optparse import OptionParser
+
+from ensemble import BuildEnsemble, EnsembleError
+
+session = None
+
+
+class MutagenesisError(Exception):
+
+    """Raised when a mutagenesis job can not be run"""
+
+class FakeWizard:
+
+    """Stand-in for the PyMOL mutagenesis wizard used by FakeCmd"""
+
+    def __init__(self, cmd):
+
+        self.cmd = cmd
+        self.mode = None
+        self.selection = None
+
+    def set_mode(self, mode):
+
+        self.mode = mode
+
+    def do_select(self, selection):
+
+        self.selection = selection
+        self.cmd.objects['mutation'] = self.cmd.rotamers
+
+    def apply(self):
+
+        self.cmd.applied.append((self.selection, self.mode, self.cmd.state))
+
+class FakeCmd:
+
+    """Stand-in for the PyMOL cmd module with just enough of its API for RunJob. Saved structures are a copy of
+       the loaded input with a REMARK naming the selection, mode and rotamer that were applied"""
+
+    def __init__(self, rotamers=3):
+
+        self.rotamers = rotamers
+        self.objects = {}
+        self.applied = []
+        self.state = 1
+        self.current = None
+
+    def load(self, filename, name):
+
+        with open(filename, 'r') as pdb:
+            self.objects[name] = pdb.read()
+
+    def create(self, name, source):
+
+        self.objects[name] = self.objects[source]
+
+    def delete(self, name):
+
+        self.objects.pop(name, None)
+
+    def select(self, name, selection):
+
+        self.objects[name] = selection
+
+    def wizard(self, name):
+
+        self.current = FakeWizard(self)
+
+    def get_wizard(self):
+
+        return self.current
+
+    def set_wizard(self):
+
+        self.current = None
+
+    def count_states(self, name):
+
+        return self.objects.get(name, 0)
+
+    def frame(self, state):
+
+        self.state = state
+
+    def save(self, filename, name):
+
+        selection, mode, state = self.applied[-1]
+        with open(filename, 'w') as pdb:
+            pdb.write('REMARK   mutagenesis %s to %s rotamer %i\n' % (selection, mode, state))
+            pdb.write(self.objects[name])
+
+def InitWorker(structure, fake=False):
+
+    """Start the PyMOL instance of a worker process and load the input structure once"""
+
+    global session
+
+    if fake == True:
+        session = FakeCmd()
+    else:
+        import pymol2
+        instance = pymol2.PyMOL()
+        instance.start()
+        session = instance.cmd
+
+    session.load(structure, 'protein')
+
+def ParseJobs(args, jobfile=None):
+
+    """(chain, resi, aa) jobs from CHAIN:RESI:AA arguments and a job file with one 'CHAIN RESI AA' per line"""
+
+    specs = [arg.split(':') for arg in args]
+    if jobfile != None:
+        with open(jobfile, 'r') as jobs:
+            specs.extend(line.split() for line in jobs if line.strip() and not line.startswith('#'))
+
+    jobs = []
+    for spec in specs:
+        if len(spec) != 3 or not spec[1].lstrip('-').isdigit():
+            raise MutagenesisError("Can not read job %s, use CHAIN:RESI:AA" % ':'.join(spec))
+        jobs.append((spec[0], int(spec[1]), spec[2].upper()))
+
+    return jobs
+
+def RunJob(chain, resi, aa, outdir, ensemble=False):
+
+    """Apply every rotamer of the mutation of residue resi in chain to aa and save each one as
+       conformation<k>_<resi>.pdb. Runs in a worker started with InitWorker. Returns the written files"""
+
+    cmd = session
+    jobdir = os.path.join(outdir, 'mutant_%s%i%s' % (chain, resi, aa))
+    if not os.path.isdir(jobdir):
+        os.makedirs(jobdir)
+
+    selection = '/work//%s/%i/' % (chain, resi)
+    written = []
+    rotamer = 1
+    nrrotamers = 1
+    while rotamer <= nrrotamers:
+        # The wizard modifies the structure it is applied to, every rotamer starts from a fresh copy
+        cmd.delete('work')
+        cmd.create('work', 'protein')
+        cmd.wizard('mutagenesis')
+        wizard = cmd.get_wizard()
+        wizard.set_mode(aa)
+        wizard.do_select(selection)
+        nrrotamers = cmd.count_states('mutation')
+        if nrrotamers == 0:
+            cmd.set_wizard()
+            raise MutagenesisError("No rotamers for %s to %s" % (selection, aa))
+        cmd.frame(rotamer)
+        wizard.apply()
+        cmd.set_wizard()
+
+        path = os.path.join(jobdir, 'conformation%i_%i.pdb' % (rotamer, resi))
+        cmd.save(path, 'work')
+        written.append(path)
+        rotamer = rotamer+1
+
+    cmd.delete('work')
+
+    if ensemble == True:
+        written.append(BuildEnsemble(written, os.path.join(jobdir, 'ensemble.pdb')))
+
+    return written
+
+def RunJobs(structure, jobs, outdir='.', workers=None, ensemble=False, fake=False):
+
+    """Run all mutagenesis jobs over a pool of worker processes that each load structure once. A failing job
+       is reported and does not stop the others. Returns {job: error message} for the failed jobs"""
+
+    if fake == False and find_spec('pymol2') == None:
+        raise MutagenesisError("pymol2 is not installed, use --fake to test without PyMOL")
+
+    failed = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=InitWorker, initargs=(structure, fake)) as pool:
+        futures = {}
+        for job in jobs:
+            futures[pool.submit(RunJob, job[0], job[1], job[2], outdir, ensemble)] = job
+        for future in as_completed(futures):
+            job = futures[future]
+            name = '%s:%i:%s' % job
+            try:
+                written = future.result()
+                print("    * Job %s: %i files written" % (name, len(written)))
+            except (MutagenesisError, EnsembleError, IOError) as error:
+                failed[name] = str(error)
+                print("    * ERROR: Job %s failed: %s" % (name, error))
+
+    return failed
+
+def SelfTest(workers=1):
+
+    """Run two jobs on a small generated structure with the PyMOL stand-in in a temporary directory and check
+       that every rotamer and the ensemble.pdb of every job are written. Returns a list of problems, empty when
+       all is well"""
+
+    tmpdir = tempfile.mkdtemp(prefix='mutagenesis.')
+    try:
+        structure = os.path.join(tmpdir, 'protein.pdb')
+        with open(structure, 'w') as pdb:
+            for n, (name, resi) in enumerate([('N', 477), ('CA', 477), ('N', 478), ('CA', 478)]):
+                pdb.write('ATOM  %5i  %-3s ALA B%4i    %8.3f%8.3f%8.3f  1.00  0.00\n' % (n+1, name, resi, n*1.5, 0.0, 0.0))
+            pdb.write('END\n')
+
+        jobs = [('B', 477, 'ASN'), ('B', 478, 'LYS')]
+        problems = ['Job %s failed: %s' % item for item in RunJobs(structure, jobs, outdir=tmpdir, workers=workers, ensemble=True, fake=True).items()]
+        rotamers = FakeCmd().rotamers
+        for chain, resi, aa in jobs:
+            jobdir = os.path.join(tmpdir, 'mutant_%s%i%s' % (chain, resi, aa))
+            expected = ['conformation%i_%i.pdb' % (rotamer, resi) for rotamer in range(1, rotamers+1)] + ['ensemble.pdb']
+            problems.extend('%s not written' % os.path.join(os.path.basename(jobdir), name) for name in expected
+                            if not os.path.isfile(os.path.join(jobdir, name)))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return problems
+
+if __name__ == '__main__':
+
+    """Running from the command line"""
+
+    parser = OptionParser("usage: %prog structure.pdb [CHAIN:RESI:AA ...]" + USAGE)
+    parser.add_option( "-f", "--file", dest="jobfile", type="string", default=None, help="File with one 'CHAIN RESI AA' job per line")
+    parser.add_option( "-o", "--outdir", dest="outdir", type="string", default=".", help="Directory the mutant_<chain><resi><aa> directories are written to, default=current directory")
+    parser.add_option( "-j", "--workers", dest="workers", type="int", default=None, help="Number of worker processes, default=number of CPUs")
+    parser.add_option( "-e", "--ensemble", action="store_true", dest="ensemble", default=False, help="Also build the ensemble.pdb of every job")
+    parser.add_option( "--fake", action="store_true", dest="fake", default=False, help="Use a stand-in for PyMOL, for testing")
+    parser.add_option( "--selftest", action="store_true", dest="selftest", default=False, help="Check the job driver with the PyMOL stand-in on a generated structure and exit")
+    (options, args) = parser.parse_args()
+
+    if options.selftest == True:
+        problems = SelfTest(workers=options.workers)
+        for problem in problems:
+            print("    * ERROR: %s" % problem)
+        print("--> Self test %s" % ('failed' if problems else 'passed'))
+        sys.exit(1 if problems else 0)
+
+    if len(args) == 0 or not os.path.isfile(args[0]):
+        print("    * ERROR: Supply the input structure as first argument")
+        sys.exit(0)
+
+    try:
+        jobs = ParseJobs(args[1:], jobfile=options.jobfile)
+    except (MutagenesisError, IOError) as error:
+        print("    * ERROR: %s" % error)
+        sys.exit(0)
+
+    print("--> Running %i mutagenesis jobs" % len(jobs))
+    try:
+        failed = RunJobs(args[0], jobs, outdir=options.outdir, workers=options.workers, ensemble=options.ensemble, fake=options.fake)
+    except MutagenesisError as error:
+        print("    * ERROR: %s" % error)
+        sys.exit(0)
+    print("--> %i jobs failed" % len(failed) if failed else "--> All jobs done")
+    sys.exit(0)